@@ -0,0 +1,67 @@
+"""
+Compare two benchmark result files written by run.py, ex. from two commits.
+
+    python benchmark/compare.py before.jsonl after.jsonl --threshold 0.1
+"""
+import json
+import statistics
+
+import fire
+
+
+def load(filepath: str) -> dict:
+    """
+    Median seconds and peak RSS per benchmark, ignoring failed runs.
+    """
+    runs = {}
+    with open(filepath) as f:
+        for line in f:
+            record = json.loads(line)
+            if "error" in record:
+                continue
+            runs.setdefault(record["benchmark"], []).append(record)
+    return {
+        name: {
+            "seconds": statistics.median(r["seconds"] for r in records),
+            "peak_rss": statistics.median(r["peak_rss"] for r in records),
+        }
+        for name, records in runs.items()
+    }
+
+
+def main(before: str, after: str, threshold: float = 0.1):
+    """
+    Print time and memory ratios of after over before, and exit with status
+    1 if any benchmark got slower or bigger by more than threshold.
+
+    Args:
+        before: str
+            Baseline results file.
+        after: str
+            New results file.
+        threshold: float [optional]
+            Relative increase counted as a regression. Default 0.1.
+    """
+    old, new = load(before), load(after)
+    regressed = False
+    header = ["benchmark", "time", "ratio", "peak RSS", "ratio"]
+    print("{:30s} {:>10s} {:>7s} {:>10s} {:>7s}".format(*header))
+    for name in sorted(set(old) & set(new)):
+        time_ratio = new[name]["seconds"] / old[name]["seconds"]
+        rss_ratio = new[name]["peak_rss"] / old[name]["peak_rss"]
+        flag = ""
+        if time_ratio > 1 + threshold or rss_ratio > 1 + threshold:
+            regressed = True
+            flag = " <-- regression"
+        print(
+            f"{name:30s} {new[name]['seconds']:9.2f}s {time_ratio:7.2f}"
+            f" {new[name]['peak_rss'] / 2 ** 20:8.0f}MB {rss_ratio:7.2f}{flag}"
+        )
+    for name in sorted(set(old) ^ set(new)):
+        print(f"{name:30s} only in {'before' if name in old else 'after'}")
+    if regressed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,126 @@
+"""
+Synthetic whole-slide fixtures for benchmarks, generated locally.
+"""
+import json
+from pathlib import Path
+
+import h5py
+import numpy as np
+import tifffile
+from skimage.segmentation import expand_labels
+
+from pcatk.external import ashlar_pyramid
+
+
+def make_mask(
+    shape: tuple, num_cells: int, radius: int = 6, seed: int = 0
+) -> np.ndarray:
+    """
+    Label mask of roughly round cells grown from random nuclei.
+
+    Args:
+        shape: tuple of int
+            Image shape.
+        num_cells: int
+            Number of cells to seed, touching seeds may merge.
+        radius: int [optional]
+            Cell radius in pixels. Default 6.
+        seed: int [optional]
+            Random seed. Default 0.
+
+    Return: np.ndarray of int32
+    """
+    rng = np.random.default_rng(seed)
+    mask = np.zeros(shape, dtype=np.int32)
+    rr = rng.integers(0, shape[0], num_cells)
+    cc = rng.integers(0, shape[1], num_cells)
+    mask[rr, cc] = np.arange(1, num_cells + 1, dtype=np.int32)
+    return expand_labels(mask, distance=radius)
+
+
+def make_channels(mask: np.ndarray, num_channels: int, seed: int = 0) -> np.ndarray:
+    """
+    uint16 channels with a random level per cell and channel plus noise, so
+    cells correlate across channels to a varying degree.
+
+    Args:
+        mask: np.ndarray
+            Label mask from make_mask.
+        num_channels: int
+            Number of channels.
+        seed: int [optional]
+            Random seed. Default 0.
+
+    Return: np.ndarray of shape (num_channels, N, M)
+    """
+    rng = np.random.default_rng(seed)
+    shared = rng.gamma(2.0, 2000.0, mask.max() + 1)
+    out = np.empty((num_channels,) + mask.shape, dtype=np.uint16)
+    for c in range(num_channels):
+        level = shared * rng.uniform(0, 1) + rng.gamma(2.0, 1000.0, shared.size)
+        level[0] = 200
+        noise = rng.normal(0, 300, mask.shape)
+        out[c] = np.clip(level[mask] + noise, 0, 65535).astype(np.uint16)
+    return out
+
+
+def make_fixtures(
+    folderpath: str,
+    size: int = 4096,
+    num_channels: int = 4,
+    num_cells: int = 20000,
+    tile_size: int = 1024,
+    seed: int = 0,
+) -> Path:
+    """
+    Write mask and channels as TIFF, HDF5 and pyramidal ome.tif, once per
+    parameter set. Subsequent calls with the same parameters reuse them.
+
+    Args:
+        folderpath: str
+            Parent folder of fixture sets.
+        size: int [optional]
+            Edge length of the square slide. Default 4096.
+        num_channels: int [optional]
+            Number of channels. Default 4.
+        num_cells: int [optional]
+            Number of cells seeded. Default 20000.
+        tile_size: int [optional]
+            Tile size of the ome.tif pyramid. Default 1024.
+        seed: int [optional]
+            Random seed. Default 0.
+
+    Return: pathlib.Path of the fixture set folder
+    """
+    params = {
+        "size": size,
+        "num_channels": num_channels,
+        "num_cells": num_cells,
+        "tile_size": tile_size,
+        "seed": seed,
+    }
+    name = "s{size}_c{num_channels}_n{num_cells}_t{tile_size}_r{seed}".format(**params)
+    out_folderpath = Path(folderpath) / name
+    if (out_folderpath / "params.json").is_file():
+        return out_folderpath
+    (out_folderpath / "channels").mkdir(parents=True, exist_ok=True)
+
+    mask = make_mask((size, size), num_cells, seed=seed)
+    channels = make_channels(mask, num_channels, seed=seed)
+    tifffile.imwrite(out_folderpath / "mask.tif", mask)
+    with h5py.File(out_folderpath / "slide.h5", "w") as f:
+        f.create_dataset("mask", data=mask, chunks=(256, 256))
+        for c, channel in enumerate(channels):
+            f.create_dataset(str(c + 1), data=channel, chunks=(256, 256))
+    for c, channel in enumerate(channels):
+        tifffile.imwrite(out_folderpath / "channels" / f"{c + 1}.tif", channel)
+    ashlar_pyramid.build_pyramid(
+        array_list=list(channels),
+        channel_name_list=[str(c + 1) for c in range(num_channels)],
+        out_path=str(out_folderpath / "slide.ome.tif"),
+        tile_size=tile_size,
+        verbose=False,
+    )
+    params["num_labels"] = int(np.unique(mask).size - 1)
+    (out_folderpath / "params.json").write_text(json.dumps(params))
+    return out_folderpath
@@ -0,0 +1,533 @@
+"""
+Time pcatk entry points on synthetic fixtures and append one JSON line per
+benchmark, so results can be compared across commits with compare.py.
+
+    python benchmark/run.py --size 4096 --num_cells 20000 --out results.jsonl
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+from pathlib import Path
+
+import fire
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import fixtures  # noqa: E402
+
+
+CASES = {}
+
+
+def case(func):
+    """
+    Register a benchmark. The function receives the fixture folder, a
+    scratch folder and the fixture parameters, loads its inputs and returns
+    (callable to time, pixels processed, cells processed).
+    """
+    CASES[func.__name__] = func
+    return func
+
+
+@case
+def build_pyramid(fixture, workdir, params):
+    import tifffile
+    from pcatk.external import ashlar_pyramid
+
+    paths = sorted((fixture / "channels").iterdir())
+    array_list = [tifffile.imread(p) for p in paths]
+
+    def run():
+        ashlar_pyramid.build_pyramid(
+            array_list,
+            [p.stem for p in paths],
+            str(workdir / "out.ome.tif"),
+            tile_size=params["tile_size"],
+            verbose=False,
+        )
+
+    return run, params["size"] ** 2 * params["num_channels"], 0
+
+
+@case
+def tif2ometif(fixture, workdir, params):
+    from pcatk import convert
+
+    def run():
+        convert.tif2ometif(
+            fixture / "channels",
+            workdir / "out.ome.tif",
+            tile_size=params["tile_size"],
+            verbose=False,
+        )
+
+    return run, params["size"] ** 2 * params["num_channels"], 0
+
+
+@case
+def ometif2tif(fixture, workdir, params):
+    from pcatk import convert
+
+    def run():
+        convert.ometif2tif(fixture / "slide.ome.tif", workdir / "out")
+
+    return run, params["size"] ** 2 * params["num_channels"], 0
+
+
+@case
+def ometif2hdf5(fixture, workdir, params):
+    from pcatk import convert
+
+    def run():
+        convert.ometif2hdf5(fixture / "slide.ome.tif", workdir / "out.h5")
+
+    return run, params["size"] ** 2 * params["num_channels"], 0
+
+
+@case
+def ometif2roi(fixture, workdir, params):
+    from pcatk import convert
+
+    size = params["size"]
+    # a 3 x 3 grid of regions, each a quarter of the slide edge
+    edge, step = size // 4, size // 3
+    roi_dict = {
+        f"{i}_{j}": (i * step, i * step + edge, j * step, j * step + edge)
+        for i in range(3)
+        for j in range(3)
+    }
+
+    def run():
+        convert.ometif2roi(
+            fixture / "slide.ome.tif", roi_dict, workdir / "out", verbose=False
+        )
+
+    return run, 9 * edge ** 2 * params["num_channels"], 0
+
+
+@case
+def ometif_add_channels(fixture, workdir, params):
+    from pcatk import convert
+
+    channel_dict = {"added": str(fixture / "channels" / "1.tif")}
+
+    def run():
+        convert.ometif_add_channels(
+            fixture / "slide.ome.tif",
+            channel_dict,
+            workdir / "out.ome.tif",
+            verbose=False,
+        )
+
+    return run, params["size"] ** 2, 0
+
+
+@case
+def ometif2zarr(fixture, workdir, params):
+    from pcatk import convert
+
+    def run():
+        convert.ometif2zarr(fixture / "slide.ome.tif", workdir / "out.zarr")
+
+    return run, params["size"] ** 2 * params["num_channels"], 0
+
+
+@case
+def zarr2ometif(fixture, workdir, params):
+    from pcatk import convert
+
+    convert.ometif2zarr(fixture / "slide.ome.tif", workdir / "in.zarr")
+
+    def run():
+        convert.zarr2ometif(
+            workdir / "in.zarr",
+            workdir / "out.ome.tif",
+            tile_size=params["tile_size"],
+            verbose=False,
+        )
+
+    return run, params["size"] ** 2 * params["num_channels"], 0
+
+
+@case
+def batch(fixture, workdir, params):
+    import json
+    from pcatk import batch
+
+    slide = str(fixture / "slide.ome.tif")
+    edge = params["size"] // 4
+    job_list = [
+        {"op": "ometif2hdf5", "in_filepath": slide, "out_filepath": "out.h5"},
+        {"op": "ometif2tif", "in_filepath": slide, "out_folderpath": "tif"},
+        {
+            "op": "ometif2roi",
+            "in_filepath": slide,
+            "roi_dict": {"roi": [0, edge, 0, edge]},
+            "out_folderpath": "roi",
+        },
+    ]
+    for job in job_list:
+        for key in ["out_filepath", "out_folderpath"]:
+            if key in job:
+                job[key] = str(workdir / job[key])
+    manifest_filepath = workdir / "manifest.jsonl"
+    manifest_filepath.write_text("".join(json.dumps(job) + "\n" for job in job_list))
+
+    def run():
+        batch.run(str(manifest_filepath), verbose=False)
+
+    pixels = (2 * params["size"] ** 2 + edge ** 2) * params["num_channels"]
+    return run, pixels, 0
+
+
+@case
+def minitile_corrcoef(fixture, workdir, params):
+    import tifffile
+    from pcatk import measure
+
+    arr1 = tifffile.imread(fixture / "channels" / "1.tif")
+    arr2 = tifffile.imread(fixture / "channels" / "2.tif")
+
+    def run():
+        measure.minitile_corrcoef(arr1, arr2, (32, 32))
+
+    return run, arr1.size, 0
+
+
+@case
+def minitile_corrcoef_sliding(fixture, workdir, params):
+    import tifffile
+    from pcatk import measure
+
+    arr1 = tifffile.imread(fixture / "channels" / "1.tif")
+    arr2 = tifffile.imread(fixture / "channels" / "2.tif")
+
+    def run():
+        measure.minitile_corrcoef(arr1, arr2, (32, 32), step=(1, 1))
+
+    return run, arr1.size, 0
+
+
+@case
+def region_corrcoef(fixture, workdir, params):
+    import tifffile
+    from pcatk import measure
+
+    arr1 = tifffile.imread(fixture / "channels" / "1.tif")
+    arr2 = tifffile.imread(fixture / "channels" / "2.tif")
+    mask = tifffile.imread(fixture / "mask.tif")
+
+    def run():
+        measure.region_corrcoef(arr1, arr2, mask)
+
+    return run, mask.size, params["num_labels"]
+
+
+@case
+def region_corrcoef_lazy(fixture, workdir, params):
+    from pcatk import measure
+    from pcatk.util import TiffArray
+
+    arr1 = TiffArray(fixture / "slide.ome.tif", channel=1)
+    arr2 = TiffArray(fixture / "slide.ome.tif", channel=2)
+    mask = TiffArray(fixture / "mask.tif")
+
+    def run():
+        measure.region_corrcoef(arr1, arr2, mask, tile_size=params["tile_size"])
+
+    return run, mask.shape[0] * mask.shape[1], params["num_labels"]
+
+
+@case
+def region_features(fixture, workdir, params):
+    import tifffile
+    from pcatk import measure
+
+    image_dict = {
+        p.stem: tifffile.imread(p) for p in sorted((fixture / "channels").iterdir())
+    }
+    mask = tifffile.imread(fixture / "mask.tif")
+
+    def run():
+        measure.region_features(image_dict, mask, correlation=True)
+
+    return run, mask.size * len(image_dict), params["num_labels"]
+
+
+@case
+def pixel2mask(fixture, workdir, params):
+    import numpy as np
+    import tifffile
+    from pcatk import feature
+
+    image = tifffile.imread(fixture / "channels" / "1.tif")
+    low, high = np.percentile(image[::16, ::16], [50, 95])
+
+    def run():
+        feature.pixel2mask(image, low, high)
+
+    return run, image.size, 0
+
+
+@case
+def pixel2mask_tiled(fixture, workdir, params):
+    import h5py
+    import numpy as np
+    from pcatk import feature
+
+    f = h5py.File(fixture / "slide.h5", "r")
+    image = f["1"]
+    low, high = np.percentile(image[::16, ::16], [50, 95])
+
+    def run():
+        feature.pixel2mask(image, low, high, tile_size=params["tile_size"])
+
+    return run, image.size, 0
+
+
+@case
+def index_cells(fixture, workdir, params):
+    import tifffile
+    from pcatk import exemplar
+
+    mask = tifffile.imread(fixture / "mask.tif")
+
+    def run():
+        exemplar.index_cells(mask)
+
+    return run, mask.size, params["num_labels"]
+
+
+@case
+def sample(fixture, workdir, params):
+    import tifffile
+    from pcatk import exemplar
+
+    mask = tifffile.imread(fixture / "mask.tif")
+    index_filepath = workdir / "mask.cells.npz"
+    exemplar.index_cells(mask, index_filepath=index_filepath)
+
+    def run():
+        for seed in range(100):
+            exemplar.sample(
+                mask, (64, 64), 100, seed=seed, index_filepath=index_filepath
+            )
+
+    return run, 0, 100 * 100
+
+
+@case
+def render(fixture, workdir, params):
+    import h5py
+    from pcatk import exemplar
+
+    f = h5py.File(fixture / "slide.h5", "r")
+    colors = ["red", "green", "blue", "magenta", "cyan", "yellow"]
+    image_dict = {color: f[str(c + 1)] for c, color in enumerate(colors[:3])}
+    slice_dict = exemplar.sample(
+        f["mask"], (64, 64), 200, seed=0, index_filepath=workdir / "mask.cells.npz"
+    )
+
+    def run():
+        exemplar.render(slice_dict, image_dict, workdir / "cells")
+
+    return run, len(slice_dict) * 64 * 64 * len(image_dict), len(slice_dict)
+
+
+@case
+def assemble(fixture, workdir, params):
+    import numpy as np
+    import skimage.io as sio
+    from pcatk import exemplar
+
+    rng = np.random.default_rng(0)
+    (workdir / "cells").mkdir()
+    for i in range(400):
+        image = rng.integers(0, 255, (64, 64, 3), dtype=np.uint8)
+        sio.imsave(workdir / "cells" / f"{i:04d}.png", image, check_contrast=False)
+
+    def run():
+        exemplar.assemble(workdir / "cells", workdir / "out.tif", (20, 20), 2)
+
+    return run, 400 * 68 * 68, 400
+
+
+def subprocess_env() -> dict:
+    # the repository root, for pcatk to import in a fresh interpreter
+    root = str(Path(__file__).resolve().parents[1])
+    path = os.environ.get("PYTHONPATH")
+    return {**os.environ, "PYTHONPATH": f"{root}{os.pathsep}{path}" if path else root}
+
+
+@case
+def import_time(fixture, workdir, params):
+    modules = "pcatk.convert, pcatk.measure, pcatk.exemplar, pcatk.feature"
+    command = [sys.executable, "-c", f"import {modules}"]
+
+    def run():
+        subprocess.run(command, check=True, env=subprocess_env())
+
+    return run, 0, 0
+
+
+@case
+def cli_help(fixture, workdir, params):
+    command = [sys.executable, "-m", "pcatk", "--help"]
+
+    def run():
+        subprocess.run(
+            command, check=True, stdout=subprocess.DEVNULL, env=subprocess_env()
+        )
+
+    return run, 0, 0
+
+
+@case
+def cli_roi(fixture, workdir, params):
+    # one small region, so start-up dominates
+    edge = min(256, params["size"])
+    roi_filepath = workdir / "rois.csv"
+    roi_filepath.write_text(f"name,xl,xu,yl,yu\nroi,0,{edge},0,{edge}\n")
+    command = [
+        sys.executable,
+        "-m",
+        "pcatk",
+        "ometif2roi",
+        str(fixture / "slide.ome.tif"),
+        str(roi_filepath),
+        str(workdir / "out"),
+    ]
+
+    def run():
+        subprocess.run(
+            command, check=True, stdout=subprocess.DEVNULL, env=subprocess_env()
+        )
+
+    return run, edge ** 2 * params["num_channels"], 0
+
+
+def run_case(name, fixture, params, queue):
+    workdir = Path(tempfile.mkdtemp(prefix=f"pcatk-bench-{name}-"))
+    # an empty cache per case, so cached stages are timed cold on every run
+    os.environ["PCATK_CACHE_DIR"] = str(workdir / "cache")
+    try:
+        func, pixels, cells = CASES[name](fixture, workdir, params)
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - start
+        usage_self = resource.getrusage(resource.RUSAGE_SELF)
+        usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        queue.put(
+            {
+                "seconds": seconds,
+                # ru_maxrss is in KiB on Linux
+                "peak_rss": usage_self.ru_maxrss * 1024,
+                "setup_peak_rss": rss_before * 1024,
+                "peak_rss_children": usage_children.ru_maxrss * 1024,
+                "pixels_per_s": pixels / seconds if pixels else None,
+                "cells_per_s": cells / seconds if cells else None,
+            }
+        )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).resolve().parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(
+    out: str = None,
+    cases: str = None,
+    size: int = 4096,
+    num_channels: int = 4,
+    num_cells: int = 20000,
+    tile_size: int = 1024,
+    seed: int = 0,
+    repeat: int = 1,
+    fixture_folderpath: str = None,
+):
+    """
+    Run benchmarks, each in a fresh process so peak RSS is its own.
+
+    Args:
+        out: str [optional]
+            JSON lines file to append results to. Default None, stdout.
+        cases: str [optional]
+            Comma-separated benchmark names. Default None, all of them.
+        size: int [optional]
+            Edge length of the synthetic slide. Default 4096.
+        num_channels: int [optional]
+            Number of channels. Default 4.
+        num_cells: int [optional]
+            Number of cells seeded in the mask. Default 20000.
+        tile_size: int [optional]
+            Tile size of fixtures and tiled modes. Default 1024.
+        seed: int [optional]
+            Random seed of the fixtures. Default 0.
+        repeat: int [optional]
+            Runs per benchmark. Default 1.
+        fixture_folderpath: str [optional]
+            Where fixtures are generated and cached. Default None, a
+            pcatk-bench folder in the system temporary directory.
+    """
+    if fixture_folderpath is None:
+        fixture_folderpath = Path(tempfile.gettempdir()) / "pcatk-bench"
+    if cases is None:
+        name_list = list(CASES)
+    elif isinstance(cases, str):
+        name_list = cases.split(",")
+    else:
+        name_list = list(cases)
+    fixture = fixtures.make_fixtures(
+        fixture_folderpath, size, num_channels, num_cells, tile_size, seed
+    )
+    params = json.loads((fixture / "params.json").read_text())
+
+    ctx = multiprocessing.get_context("spawn")
+    common = {
+        "commit": git_commit(),
+        "host": platform.node(),
+        "cpus": os.cpu_count(),
+        "params": params,
+    }
+    out_f = sys.stdout if out is None else open(out, "a")
+    try:
+        for name in name_list:
+            for _ in range(repeat):
+                queue = ctx.Queue()
+                proc = ctx.Process(target=run_case, args=(name, fixture, params, queue))
+                proc.start()
+                proc.join()
+                record = {"benchmark": name, "time": time.time(), **common}
+                if proc.exitcode == 0:
+                    record.update(queue.get())
+                else:
+                    record["error"] = f"exit code {proc.exitcode}"
+                out_f.write(json.dumps(record) + "\n")
+                out_f.flush()
+    finally:
+        if out is not None:
+            out_f.close()
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
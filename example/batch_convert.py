@@ -0,0 +1,12 @@
+"""
+Run a manifest of conversions under a memory budget, same as
+`pcatk batch`, ex.
+
+    python batch_convert.py manifest.jsonl --memory_limit 8e9
+"""
+import sys
+
+import pcatk.cli
+
+if __name__ == "__main__":
+    pcatk.cli.main(["batch"] + sys.argv[1:])
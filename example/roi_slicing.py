@@ -1,14 +1,12 @@
-import fire
+"""
+Cut regions listed in a CSV file out of an ome.tif, same as
+`pcatk ometif2roi`, ex.
 
-import pcatk
-
-def run():
-    """
-    pcatk.convert.ometif2tif
-    for img in folder.iterdir(): imsave(img[xl:xu, yl:yu])
-    pcatk.convert.tif2ometif
-    """
+    python roi_slicing.py slide.ome.tif rois.csv out/ --level 1
+"""
+import sys
 
+import pcatk.cli
 
 if __name__ == "__main__":
-    fire.Fire(run)
+    pcatk.cli.main(["ometif2roi"] + sys.argv[1:])
@@ -0,0 +1,28 @@
+"""
+Analysis toolkit for the Pre-Cancer Atlas project. Submodules are imported
+on first access, ex. pcatk.convert, so importing pcatk itself is cheap.
+"""
+import importlib
+
+__all__ = [
+    "batch",
+    "cache",
+    "cli",
+    "convert",
+    "exemplar",
+    "external",
+    "feature",
+    "measure",
+    "metrics",
+    "util",
+]
+
+
+def __getattr__(name: str):
+    if name in __all__:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,319 @@
+import os
+import sys
+import json
+import time
+import typing
+import hashlib
+import inspect
+import contextlib
+import concurrent.futures
+from pathlib import Path
+
+import numpy as np
+import tifffile
+
+from . import convert
+from .util import default_num_workers, level_pages
+
+# operation name -> (function, keyword of its output path)
+OPERATIONS = {
+    "ometif2tif": (convert.ometif2tif, "out_folderpath"),
+    "ometif2hdf5": (convert.ometif2hdf5, "out_filepath"),
+    "tif2ometif": (convert.tif2ometif, "out_filepath"),
+    "ometif2roi": (convert.ometif2roi, "out_folderpath"),
+    "ometif2zarr": (convert.ometif2zarr, "out_filepath"),
+    "zarr2ometif": (convert.zarr2ometif, "out_filepath"),
+    "ometif_add_channels": (convert.ometif_add_channels, "out_filepath"),
+}
+
+
+def load_manifest(manifest_filepath: str) -> typing.List[dict]:
+    """
+    Read a manifest of jobs, one JSON object per line with key "op" naming
+    the operation and the other keys passed as its keyword arguments, ex.
+    {"op": "ometif2hdf5", "in_filepath": "a.ome.tif", "out_filepath": "a.h5"}.
+    Empty lines and lines starting with # are skipped.
+
+    Args:
+        manifest_filepath: str
+            Manifest file path.
+
+    Return: list of dict
+    """
+    job_list = []
+    with open(manifest_filepath) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            job = json.loads(line)
+            if job.get("op") not in OPERATIONS:
+                raise ValueError(
+                    f"{manifest_filepath}:{line_number}: unknown op {job.get('op')}"
+                )
+            job_list.append(job)
+    return job_list
+
+
+def job_key(job: dict) -> str:
+    """
+    Identifier of a job, stable across runs of the same manifest line.
+    """
+    text = json.dumps(job, sort_keys=True, default=str)
+    return hashlib.blake2b(text.encode(), digest_size=12).hexdigest()
+
+
+def _page_nbytes(page) -> typing.Tuple[int, int]:
+    # bytes of the whole page, and of one decoded tile or the whole page
+    keyframe = page.keyframe
+    itemsize = keyframe.dtype.itemsize
+    nbytes = int(np.prod(keyframe.shape)) * itemsize
+    if keyframe.is_tiled:
+        return nbytes, keyframe.tilelength * keyframe.tilewidth * itemsize
+    return nbytes, nbytes
+
+
+def estimate_memory(job: dict) -> int:
+    """
+    Peak bytes a job is expected to hold, from the shapes and dtypes of its
+    inputs and the worker and memory limits it is given.
+
+    Args:
+        job: dict
+            Manifest entry.
+
+    Return: int
+    """
+    op = job["op"]
+    num_workers = job.get("num_workers") or default_num_workers()
+    if op in ("ometif2tif", "ometif2hdf5"):
+        with tifffile.TiffFile(job["in_filepath"]) as tif:
+            page = tif.series[0].pages[0]
+            _, unit = _page_nbytes(page)
+            workers = convert.channel_workers(
+                page, num_workers, job.get("memory_limit", 2 ** 30)
+            )
+        return workers * unit
+    if op in ("tif2ometif", "zarr2ometif"):
+        if op == "tif2ometif":
+            path = sorted(Path(job["in_folderpath"]).iterdir())[0]
+            with tifffile.TiffFile(path) as tif:
+                nbytes, _ = _page_nbytes(tif.pages[0])
+        else:
+            image = next(iter(convert.zarr_channels(job["in_filepath"]).values()))
+            nbytes = int(np.prod(image.shape)) * image.dtype.itemsize
+        # channels in flight in shared memory, plus the one being read
+        pending = min(num_workers, max(1, job.get("memory_limit", 2 ** 32) // nbytes))
+        return (pending + 1) * nbytes
+    if op == "ometif2roi":
+        with tifffile.TiffFile(job["in_filepath"]) as tif:
+            pages = level_pages(tif, job.get("level", 0))
+            shape = pages[0].keyframe.shape
+            itemsize = pages[0].keyframe.dtype.itemsize
+            num_channels = len(pages)
+        pixels = 0
+        for xl, xu, yl, yu in job["roi_dict"].values():
+            rows = max(0, min(xu, shape[0]) - max(xl, 0))
+            cols = max(0, min(yu, shape[1]) - max(yl, 0))
+            pixels += rows * cols
+        # every region of every channel is read before pyramids are built
+        return 2 * pixels * num_channels * itemsize
+    if op == "ometif2zarr":
+        with tifffile.TiffFile(job["in_filepath"]) as tif:
+            page = level_pages(tif, 0)[0]
+            width = page.keyframe.shape[1]
+            itemsize = page.keyframe.dtype.itemsize
+        # each thread holds two rows of chunks of the level above
+        return num_workers * 3 * job.get("chunk_size", 1024) * width * itemsize
+    if op == "ometif_add_channels":
+        with tifffile.TiffFile(job["in_filepath"]) as tif:
+            nbytes, _ = _page_nbytes(level_pages(tif, 0)[0])
+        return 2 * nbytes
+    return 0
+
+
+def job_paths(job: dict) -> typing.Tuple[typing.Set[str], typing.Optional[str]]:
+    """
+    Input and output paths of a job, absolute, to order jobs that read or
+    write what an earlier job writes.
+
+    Return: tuple of (set of str, str or None)
+    """
+    _, output_key = OPERATIONS[job["op"]]
+    input_list = [job.get("in_filepath"), job.get("in_folderpath")]
+    channel_dict = job.get("channel_dict", {})
+    input_list += [v for v in channel_dict.values() if isinstance(v, str)]
+    # ometif_add_channels updates its input when out_filepath is not given
+    output = job.get(output_key) or job.get("in_filepath")
+    inputs = {os.path.abspath(p) for p in input_list if p is not None}
+    return inputs, None if output is None else os.path.abspath(output)
+
+
+def _overlap(path1: typing.Optional[str], path2: typing.Optional[str]) -> bool:
+    # same path, or one inside the other as for output folders
+    if path1 is None or path2 is None:
+        return False
+    return (
+        path1 == path2
+        or path1.startswith(path2 + os.sep)
+        or path2.startswith(path1 + os.sep)
+    )
+
+
+def conflicts(job: dict, other: dict) -> bool:
+    """
+    Whether two jobs cannot run at once: one reads or writes what the other
+    writes.
+    """
+    inputs, output = job_paths(job)
+    other_inputs, other_output = job_paths(other)
+    return (
+        _overlap(output, other_output)
+        or any(_overlap(other_output, path) for path in inputs)
+        or any(_overlap(output, path) for path in other_inputs)
+    )
+
+
+def run_job(job: dict, log_filepath: str = None) -> float:
+    """
+    Run one manifest entry, with its printed output sent to a log file.
+
+    Return: float, seconds taken
+    """
+    function, _ = OPERATIONS[job["op"]]
+    kwargs = {key: value for key, value in job.items() if key != "op"}
+    start = time.perf_counter()
+    with open(log_filepath or os.devnull, "w") as log, contextlib.redirect_stdout(log):
+        function(**kwargs)
+    return time.perf_counter() - start
+
+
+def run(
+    manifest_filepath: str,
+    memory_limit: int = 2 ** 34,
+    num_jobs: int = None,
+    state_filepath: str = None,
+    log_folderpath: str = None,
+    verbose: bool = True,
+) -> typing.Dict[str, list]:
+    """
+    Run the jobs of a manifest concurrently in a process pool. Jobs are
+    started in manifest order as long as their estimated memory fits in
+    what the running jobs leave of the budget; a job larger than the whole
+    budget runs alone. A job is estimated when it is next in line, and
+    waits for running jobs that write one of its inputs or its output, or
+    read its output, so it can read the output of an earlier job and
+    update a file in place after earlier jobs reading it. Finished jobs are recorded in a state file,
+    and skipped when the manifest is run again while their output still
+    exists.
+
+    Args:
+        manifest_filepath: str
+            Manifest file path, see load_manifest.
+        memory_limit: int [optional]
+            Memory budget in bytes shared by running jobs. Default 16 GiB.
+        num_jobs: int [optional]
+            Upper limit of jobs running at once. Jobs without num_workers
+            share the available CPUs evenly. Default None, as many as
+            available CPUs.
+        state_filepath: str [optional]
+            JSON lines file recording finished jobs. Default None, the
+            manifest path with suffix .state.
+        log_folderpath: str [optional]
+            Folder to save the printed output of each job to, as
+            {key}.log. Default None, discarded.
+        verbose: bool [optional]
+            Print a line per started, finished or failed job. Default True.
+
+    Return: dict of str -> list
+        Keys "done", "skipped" and "failed", each a list of job keys.
+    """
+    # preprocessing
+    job_list = load_manifest(manifest_filepath)
+    if state_filepath is None:
+        state_filepath = f"{manifest_filepath}.state"
+    if log_folderpath is not None:
+        Path(log_folderpath).mkdir(parents=True, exist_ok=True)
+    if num_jobs is None:
+        num_jobs = default_num_workers()
+    job_workers = max(1, default_num_workers() // num_jobs)
+
+    def log(*args):
+        if verbose:
+            print(*args)
+            sys.stdout.flush()
+
+    # jobs recorded as done are skipped while their output is still there
+    done = set()
+    if os.path.exists(state_filepath):
+        with open(state_filepath) as f:
+            done = {json.loads(line)["key"] for line in f if line.strip()}
+    summary = {"done": [], "skipped": [], "failed": []}
+    queue = []
+    for job in job_list:
+        key = job_key(job)
+        output = job.get(OPERATIONS[job["op"]][1]) or job.get("in_filepath")
+        if key in done and output is not None and os.path.exists(output):
+            summary["skipped"].append(key)
+            continue
+        function, _ = OPERATIONS[job["op"]]
+        if "num_workers" in inspect.signature(function).parameters:
+            job = {"num_workers": job_workers, **job}
+        queue.append((key, job))
+    log(f"{len(queue)} jobs to run, {len(summary['skipped'])} already done")
+
+    running = {}
+    in_use = 0
+    estimate_dict = {}
+    with concurrent.futures.ProcessPoolExecutor(num_jobs) as executor, open(
+        state_filepath, "a"
+    ) as state:
+        while queue or running:
+            # admit jobs in order while they fit in the remaining budget
+            while queue and len(running) < num_jobs:
+                key, job = queue[0]
+                if any(conflicts(job, j) for _, j, _ in running.values()):
+                    break
+                if key not in estimate_dict:
+                    try:
+                        estimate_dict[key] = estimate_memory(job)
+                    except Exception as e:
+                        # ex. missing input, reported without holding back
+                        # other jobs
+                        queue.pop(0)
+                        summary["failed"].append(key)
+                        log(f"failed {key} {job['op']}: {e!r}")
+                        continue
+                nbytes = estimate_dict[key]
+                if running and in_use + nbytes > memory_limit:
+                    break
+                queue.pop(0)
+                log_filepath = None
+                if log_folderpath is not None:
+                    log_filepath = str(Path(log_folderpath) / f"{key}.log")
+                future = executor.submit(run_job, job, log_filepath)
+                running[future] = (key, job, nbytes)
+                in_use += nbytes
+                log(f"started {key} {job['op']} ({nbytes / 2 ** 20:.0f} MiB)")
+
+            if not running:
+                continue
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in finished:
+                key, job, nbytes = running.pop(future)
+                in_use -= nbytes
+                try:
+                    seconds = future.result()
+                except Exception as e:
+                    summary["failed"].append(key)
+                    log(f"failed {key} {job['op']}: {e!r}")
+                    continue
+                summary["done"].append(key)
+                record = {"key": key, "time": time.time(), "seconds": seconds, **job}
+                state.write(json.dumps(record, default=str) + "\n")
+                state.flush()
+                log(f"finished {key} {job['op']} in {seconds:.1f} s")
+
+    return summary
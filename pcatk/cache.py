@@ -0,0 +1,246 @@
+import os
+import uuid
+import typing
+import shutil
+import hashlib
+from pathlib import Path
+
+import numpy as np
+
+from .util import TiffArray, ChannelArray
+
+
+class DiskCache:
+    """
+    Content-addressed cache of intermediate arrays on local disk, such as
+    labelings, cell indices and label to pixel lists. Each entry is a folder
+    of .npy files named after a hash of the inputs and parameters it was
+    computed from, and is memory-mapped when read back. Least recently used
+    entries are evicted once the cache grows beyond its size limit.
+
+    Entries are written to a temporary folder and renamed into place, so
+    several processes can share one cache.
+
+    Args:
+        folderpath: str
+            Cache folder, created if missing.
+        max_bytes: int [optional]
+            Size limit of the cache. Default 8 GiB.
+    """
+
+    def __init__(self, folderpath: str, max_bytes: int = 2 ** 33):
+        self.folderpath = Path(folderpath)
+        self.max_bytes = max_bytes
+        self.folderpath.mkdir(parents=True, exist_ok=True)
+
+    def key(self, stage: str, *parts) -> str:
+        """
+        Cache key of a stage computed from inputs and parameters.
+
+        Args:
+            stage: str
+                Name of the intermediate, ex. "pixel2mask".
+            parts:
+                Inputs and parameters, arrays being fingerprinted.
+
+        Return: str
+        """
+        h = hashlib.blake2b(stage.encode(), digest_size=20)
+        for part in parts:
+            h.update(repr(fingerprint(part)).encode())
+        return f"{stage}-{h.hexdigest()}"
+
+    def get(self, key: str) -> typing.Optional[typing.Dict[str, np.ndarray]]:
+        """
+        Arrays of an entry, read-only and memory-mapped, or None if missing.
+        """
+        entry = self.folderpath / key
+        try:
+            array_dict = {
+                p.stem: np.load(p, mmap_mode="r") for p in entry.glob("*.npy")
+            }
+            # modification time of the folder orders entries for eviction
+            os.utime(entry)
+        except FileNotFoundError:
+            return None
+        return array_dict or None
+
+    def put(self, key: str, **arrays: np.ndarray):
+        """
+        Save arrays as an entry, then evict entries over the size limit.
+        """
+        tmp = self.begin(key)
+        for name, arr in arrays.items():
+            np.save(tmp / f"{name}.npy", np.asarray(arr))
+        self.commit(key, tmp)
+
+    def begin(self, key: str) -> Path:
+        """
+        Temporary folder of a new entry, to be filled with .npy files, ex.
+        with np.lib.format.open_memmap for arrays too large to hold in
+        memory, then passed to commit.
+        """
+        tmp = self.folderpath / f".{key}.{uuid.uuid4().hex}"
+        tmp.mkdir()
+        return tmp
+
+    def commit(self, key: str, tmp: Path):
+        """
+        Move a folder from begin into place as an entry, then evict entries
+        over the size limit.
+        """
+        try:
+            tmp.rename(self.folderpath / key)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits its limit.
+        """
+        entry_list = []
+        for entry in self.folderpath.iterdir():
+            if entry.name.startswith(".") or not entry.is_dir():
+                continue
+            try:
+                nbytes = sum(path.stat().st_size for path in entry.iterdir())
+                entry_list.append((entry.stat().st_mtime, nbytes, entry))
+            except FileNotFoundError:
+                continue
+        total = sum(nbytes for _, nbytes, _ in entry_list)
+        for _, nbytes, entry in sorted(entry_list, key=lambda x: x[0]):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= nbytes
+
+    def clear(self):
+        """
+        Remove every entry.
+        """
+        for entry in self.folderpath.iterdir():
+            shutil.rmtree(entry, ignore_errors=True)
+
+
+def _zarr_identity(obj: typing.Any) -> typing.Optional[tuple]:
+    """
+    Location, layout and modification time of a zarr.Array, or None for
+    arrays in memory. Chunks are files below the array folder, so writing
+    one updates the modification time of a folder in it.
+    """
+    root = getattr(obj.store, "path", None) or getattr(obj.store, "root", None)
+    if root is None:
+        return None
+    layout = (tuple(obj.shape), tuple(obj.chunks), np.dtype(obj.dtype).str)
+    folderpath = os.path.join(str(root), obj.path)
+    if not os.path.isdir(folderpath):
+        # remote stores are identified by location only
+        return ("zarr", str(root), obj.path, layout)
+    mtime = max(
+        os.stat(dirpath).st_mtime_ns for dirpath, _, _ in os.walk(folderpath)
+    )
+    return ("zarr", os.path.abspath(folderpath), layout, mtime)
+
+
+def _lazy_identity(obj: typing.Any) -> typing.Optional[tuple]:
+    """
+    Summary of a file-backed or dask array that does not read it, or None
+    for other objects.
+    """
+    if isinstance(obj, TiffArray):
+        stat = os.stat(obj.path)
+        location = (obj.path, obj.channel, obj.level)
+        return ("tiff", location, stat.st_size, stat.st_mtime_ns)
+    if hasattr(obj, "file") and hasattr(obj, "name") and hasattr(obj, "shape"):
+        # h5py.Dataset
+        stat = os.stat(obj.file.filename)
+        return ("hdf5", obj.file.filename, obj.name, stat.st_size, stat.st_mtime_ns)
+    if hasattr(obj, "store") and hasattr(obj, "path") and hasattr(obj, "chunks"):
+        return _zarr_identity(obj)
+    if hasattr(obj, "dask") and hasattr(obj, "name"):
+        # dask arrays are named by a token of their task graph
+        return ("dask", obj.name, tuple(obj.shape))
+    return None
+
+
+def fingerprint(obj: typing.Any) -> typing.Any:
+    """
+    Hashable summary of an input. File-backed arrays (TIFF, HDF5, zarr) are
+    identified by file, location in the file, layout and modification time
+    without being read, and dask arrays by the name of their graph; arrays
+    in memory by a hash of their content.
+
+    Args:
+        obj: any
+            Array, file-backed array, or plain parameter.
+
+    Return: tuple or the object itself
+    """
+    identity = _lazy_identity(obj)
+    if identity is not None:
+        return identity
+    if isinstance(obj, ChannelArray):
+        identity = _lazy_identity(obj.array)
+        if identity is not None:
+            return ("channel", identity, obj.index)
+        # channels of arrays in memory are hashed alone below
+    if isinstance(obj, (np.ndarray, np.generic)):
+        arr = np.ascontiguousarray(obj)
+        h = hashlib.blake2b(memoryview(arr).cast("B"), digest_size=20)
+        return ("array", arr.shape, arr.dtype.str, h.hexdigest())
+    if hasattr(obj, "shape") and hasattr(obj, "dtype"):
+        # other arrays are hashed a block of rows of one plane at a time
+        shape = tuple(obj.shape)
+        h = hashlib.blake2b(digest_size=20)
+        if len(shape) < 2:
+            h.update(memoryview(np.ascontiguousarray(obj[...])).cast("B"))
+        for plane in np.ndindex(*shape[:-2]) if len(shape) >= 2 else []:
+            for start in range(0, shape[-2], 1024):
+                block = np.ascontiguousarray(obj[plane + (slice(start, start + 1024),)])
+                h.update(memoryview(block).cast("B"))
+        return ("array", shape, np.dtype(obj.dtype).str, h.hexdigest())
+    if isinstance(obj, float):
+        return ("float", obj.hex())
+    return obj
+
+
+_default_cache = None
+
+
+def default_cache() -> typing.Optional[DiskCache]:
+    """
+    Cache shared by pcatk functions. Its folder is the PCATK_CACHE_DIR
+    environment variable, by default ~/.cache/pcatk, and an empty value
+    disables caching. Its size limit in bytes is PCATK_CACHE_BYTES,
+    by default 8 GiB.
+
+    Return: DiskCache, or None if disabled.
+    """
+    global _default_cache
+    folderpath = os.environ.get(
+        "PCATK_CACHE_DIR", os.path.join(Path.home(), ".cache", "pcatk")
+    )
+    if not folderpath:
+        return None
+    max_bytes = int(os.environ.get("PCATK_CACHE_BYTES", 2 ** 33))
+    if (
+        _default_cache is None
+        or str(_default_cache.folderpath) != folderpath
+        or _default_cache.max_bytes != max_bytes
+    ):
+        _default_cache = DiskCache(folderpath, max_bytes)
+    return _default_cache
+
+
+def resolve(cache: typing.Union[bool, DiskCache]) -> typing.Optional[DiskCache]:
+    """
+    Cache selected by a function argument: True for default_cache, False
+    for none, or a DiskCache.
+    """
+    if cache is True:
+        return default_cache()
+    if cache is False or cache is None:
+        return None
+    return cache
@@ -0,0 +1,422 @@
+"""
+Command line interface, ex.
+
+    pcatk ometif2hdf5 slide.ome.tif slide.h5 --chunk_size 512
+    pcatk ometif2roi slide.ome.tif rois.csv out/ --level 1
+    pcatk ometif2roi --help
+
+Only the module of the requested command is imported, so the interface
+starts quickly whatever the heavy dependencies of the other commands.
+"""
+import sys
+import json
+import typing
+import inspect
+import argparse
+import importlib
+
+# command -> (function as module:name, summary)
+COMMANDS = {
+    "ometif2tif": ("pcatk.convert:ometif2tif", "Unpack ome.tif into TIFF images."),
+    "ometif2hdf5": ("pcatk.convert:ometif2hdf5", "Convert ome.tif into HDF5."),
+    "tif2ometif": (
+        "pcatk.convert:tif2ometif",
+        "Concatenate TIFF images into a pyramidal ome.tif.",
+    ),
+    "ometif2roi": (
+        "pcatk.cli:ometif2roi",
+        "Cut regions listed in a CSV file out of an ome.tif.",
+    ),
+    "ometif2zarr": ("pcatk.convert:ometif2zarr", "Convert ome.tif into OME-NGFF zarr."),
+    "zarr2ometif": ("pcatk.convert:zarr2ometif", "Convert OME-NGFF zarr into ome.tif."),
+    "add-channels": (
+        "pcatk.convert:ometif_add_channels",
+        "Append or replace channels of an ome.tif pyramid.",
+    ),
+    "batch": ("pcatk.cli:batch", "Run a manifest of conversions concurrently."),
+    "region-features": (
+        "pcatk.cli:region_features",
+        "Tabulate per-cell features of every channel of an ome.tif.",
+    ),
+    "pixel2mask": ("pcatk.cli:pixel2mask", "Binarize a channel by hysteresis."),
+    "exemplar": ("pcatk.cli:exemplar", "Sample cells and render them as RGB images."),
+}
+
+
+def ometif2roi(
+    in_filepath: str,
+    roi_filepath: str,
+    out_folderpath: str,
+    level: int = 0,
+    tile_size: int = 1024,
+    overwrite: bool = True,
+    num_workers: int = None,
+    metrics: typing.Any = None,
+    compression: str = None,
+    predictor: bool = False,
+    subifds: bool = False,
+    verbose: bool = True,
+    scratch_dir: str = None,
+):
+    """
+    Cut regions of interest out of an ome.tif file with
+    pcatk.convert.ometif2roi.
+
+    Args:
+        in_filepath: str
+            Input ome.tif file path.
+        roi_filepath: str
+            CSV file with header name,xl,xu,yl,yu and one region per line,
+            the region being img[xl:xu, yl:yu].
+        out_folderpath: str
+            Output folder, regions are saved as {name}.ome.tif.
+        level: int [optional]
+            Pyramid level to cut from. Default 0.
+        tile_size: int [optional]
+            Tile size of the output pyramids. Default 1024.
+        overwrite: bool [optional]
+            Overwrite flag, default True.
+        num_workers: int [optional]
+            Channels read concurrently. Default None, as many as CPUs.
+        metrics: metrics.Metrics [optional]
+            Sink for per-stage timings. Default None.
+        compression: str [optional]
+            Tile compression of the outputs, ex. "zlib". Default None.
+        predictor: bool [optional]
+            Horizontal differencing before compression. Default False.
+        subifds: bool [optional]
+            Store reduced levels as SubIFDs. Default False.
+        verbose: bool [optional]
+            Print the progress of each region. Default True.
+        scratch_dir: str [optional]
+            Folder for reduced levels. Default None, out_folderpath.
+    """
+    import csv
+
+    from . import convert
+
+    with open(roi_filepath, newline="") as f:
+        roi_dict = {
+            row["name"]: tuple(int(row[k]) for k in ["xl", "xu", "yl", "yu"])
+            for row in csv.DictReader(f)
+        }
+    convert.ometif2roi(
+        in_filepath=in_filepath,
+        roi_dict=roi_dict,
+        out_folderpath=out_folderpath,
+        level=level,
+        tile_size=tile_size,
+        overwrite=overwrite,
+        num_workers=num_workers,
+        metrics=metrics,
+        compression=compression,
+        predictor=predictor,
+        subifds=subifds,
+        verbose=verbose,
+        scratch_dir=scratch_dir,
+    )
+
+
+def batch(
+    manifest_filepath: str,
+    memory_limit: int = 2 ** 34,
+    num_jobs: int = None,
+    state_filepath: str = None,
+    log_folderpath: str = None,
+):
+    """
+    Run the conversions listed in a manifest with pcatk.batch.run, exiting
+    with an error if any failed.
+
+    Args:
+        manifest_filepath: str
+            JSON lines file, one job per line with key "op" naming a
+            pcatk.convert function and its arguments.
+        memory_limit: int [optional]
+            Memory budget in bytes shared by running jobs. Default 16 GiB.
+        num_jobs: int [optional]
+            Upper limit of jobs running at once. Default None, as many as
+            available CPUs.
+        state_filepath: str [optional]
+            File recording finished jobs. Default None, next to manifest.
+        log_folderpath: str [optional]
+            Folder to save each job's output to. Default None, discarded.
+    """
+    from . import batch as batch_module
+
+    summary = batch_module.run(
+        manifest_filepath=manifest_filepath,
+        memory_limit=memory_limit,
+        num_jobs=num_jobs,
+        state_filepath=state_filepath,
+        log_folderpath=log_folderpath,
+    )
+    if summary["failed"]:
+        raise SystemExit(f"{len(summary['failed'])} jobs failed")
+
+
+def region_features(
+    in_filepath: str,
+    mask_filepath: str,
+    out_filepath: str,
+    correlation: bool = False,
+    tile_size: int = 1024,
+    num_workers: int = None,
+    processes: bool = False,
+):
+    """
+    Per-cell features of every channel of an ome.tif file with
+    pcatk.measure.region_features.
+
+    Args:
+        in_filepath: str
+            Input ome.tif file path.
+        mask_filepath: str
+            Cell mask TIFF file path, of the same shape as the channels.
+        out_filepath: str
+            Output table, Parquet if the suffix is .parquet, else CSV.
+        correlation: bool [optional]
+            Add correlation coefficients of every channel pair. Default
+            False.
+        tile_size: int [optional]
+            Edge length of tiles read at a time. Default 1024.
+        num_workers: int [optional]
+            Workers processing tiles. Default None, as many as CPUs.
+        processes: bool [optional]
+            Use processes instead of threads. Default False.
+    """
+    import tifffile
+
+    from . import convert, measure
+    from .util import TiffArray
+
+    with tifffile.TiffFile(in_filepath) as tif:
+        name_list = convert.uniquify(convert.ome_channel_names(tif))
+    image_dict = {
+        name: TiffArray(in_filepath, channel=c) for c, name in enumerate(name_list)
+    }
+    measure.region_features(
+        image_dict,
+        TiffArray(mask_filepath),
+        correlation=correlation,
+        tile_size=tile_size,
+        num_workers=num_workers,
+        processes=processes,
+        out_filepath=out_filepath,
+    )
+
+
+def pixel2mask(
+    in_filepath: str,
+    out_filepath: str,
+    low: float,
+    high: float,
+    channel: int = 0,
+    tile_size: int = 1024,
+    num_workers: int = None,
+):
+    """
+    Binarize one channel with pcatk.feature.pixel2mask and save it as a
+    uint8 TIFF image of 0 and 1.
+
+    Args:
+        in_filepath: str
+            Input TIFF or ome.tif file path.
+        out_filepath: str
+            Output TIFF file path.
+        low: float
+            Lower bound.
+        high: float
+            Higher bound.
+        channel: int [optional]
+            Channel index. Default 0.
+        tile_size: int [optional]
+            Edge length of tiles labelled at a time. Default 1024.
+        num_workers: int [optional]
+            Threads processing tiles. Default None, as many as CPUs.
+    """
+    import tifffile
+
+    from . import feature
+    from .util import TiffArray
+
+    mask = feature.pixel2mask(
+        TiffArray(in_filepath, channel=channel),
+        low,
+        high,
+        tile_size=tile_size,
+        num_workers=num_workers,
+    )
+    tifffile.imwrite(out_filepath, mask.view("uint8"))
+
+
+def exemplar(
+    in_filepath: str,
+    mask_filepath: str,
+    color_dict: typing.Dict[str, str],
+    out_folderpath: str,
+    tile_size: int = 64,
+    size: int = 100,
+    seed: int = None,
+    overwrite: bool = True,
+    num_workers: int = None,
+):
+    """
+    Sample cells of a mask and render each as an RGB image with
+    pcatk.exemplar.sample and pcatk.exemplar.render.
+
+    Args:
+        in_filepath: str
+            Input ome.tif file path.
+        mask_filepath: str
+            Cell mask TIFF file path.
+        color_dict: dict of str -> str
+            Channel name -> matplotlib named color, as JSON, ex.
+            '{"DNA": "blue", "CD3": "red"}'.
+        out_folderpath: str
+            Folder to save rendered cells.
+        tile_size: int [optional]
+            Edge length of each cell image. Default 64.
+        size: int [optional]
+            Number of cells. Default 100.
+        seed: int [optional]
+            Random seed. Default None.
+        overwrite: bool [optional]
+            Overwrite flag, default True.
+        num_workers: int [optional]
+            Threads rendering cells. Default None, as many as CPUs.
+    """
+    import tifffile
+
+    from . import convert, exemplar as exemplar_module
+    from .util import TiffArray
+
+    with tifffile.TiffFile(in_filepath) as tif:
+        name_list = convert.ome_channel_names(tif)
+    slice_dict = exemplar_module.sample(
+        TiffArray(mask_filepath), (tile_size, tile_size), size, seed=seed
+    )
+    image_dict = {
+        color: TiffArray(in_filepath, channel=name_list.index(name))
+        for name, color in color_dict.items()
+    }
+    exemplar_module.render(
+        slice_dict,
+        image_dict,
+        out_folderpath,
+        overwrite=overwrite,
+        num_workers=num_workers,
+    )
+
+
+def _load(command: str) -> typing.Callable:
+    module_name, function_name = COMMANDS[command][0].split(":")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def _arg_docs(function: typing.Callable) -> typing.Dict[str, str]:
+    # argument descriptions from the Args section of the docstring
+    doc_dict, name = {}, None
+    in_args = False
+    for line in inspect.getdoc(function).splitlines():
+        stripped = line.strip()
+        if stripped == "Args:":
+            in_args = True
+        elif in_args and line and not line.startswith(" "):
+            break
+        elif in_args and line.startswith("    ") and not line.startswith("        "):
+            name = stripped.split(":")[0]
+            for part in name.split(","):
+                doc_dict[part.strip()] = ""
+        elif in_args and name is not None and stripped:
+            for part in name.split(","):
+                doc_dict[part.strip()] = f"{doc_dict[part.strip()]} {stripped}"
+    return {key: value.strip() for key, value in doc_dict.items()}
+
+
+def _parse_json(value: str) -> typing.Any:
+    # dicts, lists and numbers are given as JSON, anything else as text
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def _parse_int(value: str) -> int:
+    # allows 4e9 for byte sizes
+    return int(float(value))
+
+
+def _parse_metrics(value: str):
+    from .metrics import JsonLinesMetrics
+
+    return JsonLinesMetrics(sys.stderr if value == "-" else value)
+
+
+def build_parser(command: str, function: typing.Callable) -> argparse.ArgumentParser:
+    """
+    Argument parser of a command from the signature and docstring of its
+    function. Arguments without default are positional, the others are
+    options named after them.
+
+    Args:
+        command: str
+            Command name.
+        function: callable
+            Function the command runs.
+
+    Return: argparse.ArgumentParser
+    """
+    doc = inspect.getdoc(function)
+    parser = argparse.ArgumentParser(
+        prog=f"pcatk {command}",
+        description=doc.split("\n\n")[0],
+    )
+    arg_docs = _arg_docs(function)
+    for name, param in inspect.signature(function).parameters.items():
+        kwargs = {"help": arg_docs.get(name, "")}
+        if name == "metrics":
+            kwargs["help"] = "JSON lines file to record metrics to, - for stderr."
+            kwargs["type"] = _parse_metrics
+        elif param.annotation is bool:
+            kwargs["action"] = argparse.BooleanOptionalAction
+        elif param.annotation is int:
+            kwargs["type"] = _parse_int
+        elif param.annotation in (float, str):
+            kwargs["type"] = param.annotation
+        else:
+            kwargs["type"] = _parse_json
+        if param.default is inspect.Parameter.empty:
+            parser.add_argument(name, **kwargs)
+        else:
+            parser.add_argument(f"--{name}", default=param.default, **kwargs)
+    return parser
+
+
+def main(argv: typing.List[str] = None):
+    """
+    Entry point of the pcatk command.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ("-h", "--help") or argv[0] not in COMMANDS:
+        width = max(len(command) for command in COMMANDS)
+        lines = ["usage: pcatk <command> [arguments]", "", "commands:"]
+        lines += [
+            f"  {command:<{width}}  {summary}"
+            for command, (_, summary) in COMMANDS.items()
+        ]
+        lines += ["", "Run pcatk <command> --help for the arguments of a command."]
+        if argv and argv[0] not in ("-h", "--help"):
+            print("\n".join(lines), file=sys.stderr)
+            raise SystemExit(f"pcatk: unknown command {argv[0]}")
+        print("\n".join(lines))
+        return
+
+    command = argv[0]
+    function = _load(command)
+    args = build_parser(command, function).parse_args(argv[1:])
+    function(**vars(args))
+
+
+if __name__ == "__main__":
+    main()
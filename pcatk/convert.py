@@ -1,11 +1,24 @@
+import time
 import typing
 import collections
+import concurrent.futures
+import xml.etree.ElementTree as ET
 from pathlib import Path
 
-import h5py
+import numpy as np
 import tifffile
 
-from .util import check_overwrite
+from .util import (
+    ChannelArray,
+    TiffArray,
+    check_overwrite,
+    default_num_workers,
+    iter_tiles,
+    level_pages,
+    read_regions,
+    segment_memmap,
+)
+from .metrics import Metrics, null_metrics
 from .external import ashlar_pyramid
 
 
@@ -20,7 +33,7 @@ def uniquify(name_list: typing.List[str]) -> typing.List[str]:
     Return: list of str, each being unique
     """
     count = collections.Counter(name_list)
-    if count.most_common(1)[1] == 1:
+    if count.most_common(1)[0][1] == 1:
         # most common name has frequency of one, meaning all names unique
         return name_list
     else:
@@ -48,11 +61,122 @@ def name_generator(start: int = 0, step: int = 1):
         x += step
 
 
+def channel_workers(
+    page: tifffile.TiffPage, num_workers: int, memory_limit: int
+) -> int:
+    """
+    Number of channels to decode at once under a memory cap.
+
+    Args:
+        page: tifffile.TiffPage
+            Representative channel page.
+        num_workers: int
+            Upper limit of workers. If None, as many as available CPUs.
+        memory_limit: int
+            Bytes of decoded pixels allowed in flight.
+
+    Return: int, at least one
+    """
+    if num_workers is None:
+        num_workers = default_num_workers()
+    keyframe = page.keyframe
+    if keyframe.is_tiled:
+        # tiles are streamed, so each worker holds about one decoded tile
+        nbytes = keyframe.tilelength * keyframe.tilewidth * keyframe.dtype.itemsize
+    else:
+        nbytes = keyframe.size * keyframe.dtype.itemsize
+    return max(1, min(num_workers, memory_limit // max(1, nbytes)))
+
+
+def _metered_tiles(page, stats: dict):
+    # iter_tiles, adding the time spent reading and decoding to stats
+    tiles = iter_tiles(page)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(tiles)
+        except StopIteration:
+            return
+        stats["decode_seconds"] += time.perf_counter() - start
+        stats["tiles"] += 1
+        yield item
+
+
+def _page2tif(
+    in_filepath: Path, index: int, out_filepath: Path, metrics: Metrics = null_metrics
+) -> typing.Optional[float]:
+    # each worker has its own file handle, so tiles can be read concurrently
+    with tifffile.TiffFile(in_filepath) as tif, metrics.timer(
+        "convert", channel=index
+    ) as timer:
+        pg = tif.series[0].pages[index]
+        keyframe = pg.keyframe
+        stats = {"decode_seconds": 0.0, "tiles": 0}
+        if not keyframe.is_tiled:
+            tifffile.imwrite(out_filepath, pg.asarray())
+        else:
+            tiles = _metered_tiles(pg, stats) if metrics.enabled else iter_tiles(pg)
+            tifffile.imwrite(
+                out_filepath,
+                (tile for _, _, tile in tiles),
+                shape=keyframe.shape,
+                dtype=keyframe.dtype,
+                tile=(keyframe.tilelength, keyframe.tilewidth),
+            )
+        if metrics.enabled:
+            timer.update(
+                bytes_read=sum(pg.databytecounts),
+                bytes_written=out_filepath.stat().st_size,
+                **stats,
+            )
+    return timer.seconds
+
+
+def _page2hdf5(
+    in_filepath: Path,
+    index: int,
+    dataset: "h5py.Dataset",
+    metrics: Metrics = null_metrics,
+) -> typing.Optional[float]:
+    with tifffile.TiffFile(in_filepath) as tif, metrics.timer(
+        "convert", channel=index
+    ) as timer:
+        pg = tif.series[0].pages[index]
+        stats = {"decode_seconds": 0.0, "tiles": 0}
+        if not pg.keyframe.is_tiled:
+            dataset[...] = pg.asarray()
+        else:
+            height, width = dataset.shape
+            tiles = _metered_tiles(pg, stats) if metrics.enabled else iter_tiles(pg)
+            for y, x, tile in tiles:
+                tile = tile[: height - y, : width - x]
+                dataset[y : y + tile.shape[0], x : x + tile.shape[1]] = tile
+        if metrics.enabled:
+            timer.update(
+                bytes_read=sum(pg.databytecounts),
+                bytes_written=dataset.size * dataset.dtype.itemsize,
+                **stats,
+            )
+    return timer.seconds
+
+
+def _record_pool(
+    metrics: Metrics, stage: str, num_workers: int, futures: list, start: float
+):
+    # wait on futures returning busy seconds, then record pool utilization
+    busy = [future.result() for future in futures]
+    if metrics.enabled:
+        metrics.pool(stage, num_workers, sum(busy), time.perf_counter() - start)
+
+
 def ometif2tif(
     in_filepath: str,
     out_folderpath: str,
     names_filepath: str = None,
     overwrite: bool = True,
+    num_workers: int = None,
+    memory_limit: int = 2 ** 30,
+    metrics: Metrics = None,
 ):
     """
     Unpack ome.tif file into a folder of TIFF images.
@@ -62,29 +186,50 @@ def ometif2tif(
             Input ome.tif file path.
         out_folderpath: str
             Output folder path.
-        name_filepath: str [optional]
+        names_filepath: str [optional]
             Text file with each line the name of the channels.
         overwrite: bool [optional]
             Overwrite output folder if already exists. Default True.
+        num_workers: int [optional]
+            Channels converted concurrently. Default None, as many as
+            available CPUs.
+        memory_limit: int [optional]
+            Bytes of decoded pixels allowed in flight, caps num_workers.
+            Default 1 GiB.
+        metrics: pcatk.metrics.Metrics [optional]
+            Sink for per-channel timings, bytes read and written, tile
+            throughput and pool utilization. Default None, not recorded.
     """
     # preprocessing
+    if metrics is None:
+        metrics = null_metrics
     in_filepath = Path(in_filepath)
     out_folderpath = Path(out_folderpath)
-    names_filepath = Path(names_filepath)
     check_overwrite(overwrite=overwrite, path=out_folderpath)
+    out_folderpath.mkdir(parents=True, exist_ok=True)
 
     # load marker name
     if names_filepath is None:
         name_list = name_generator(start=1, step=1)
     else:
-        name_list = names_filepath.read_text().splitlines()
+        name_list = Path(names_filepath).read_text().splitlines()
         name_list = uniquify(name_list)
 
-    # try to minimize memory usage here as each image can be several GB
+    # tiles are streamed from input to output, so each image never needs
+    # to be held in memory as a whole
     with tifffile.TiffFile(in_filepath) as tif:
-        for name, pg in zip(name_list, tif.series[0].pages):
-            out_filepath = out_folderpath / f"{name}.tif"
-            tifffile.imsave(out_filepath, pg.asarray())
+        pages = tif.series[0].pages
+        num_pages = len(pages)
+        num_workers = channel_workers(pages[0], num_workers, memory_limit)
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+        futures = [
+            executor.submit(
+                _page2tif, in_filepath, i, out_folderpath / f"{name}.tif", metrics
+            )
+            for i, name in zip(range(num_pages), name_list)
+        ]
+        _record_pool(metrics, "ometif2tif", num_workers, futures, start)
 
 
 def ometif2hdf5(
@@ -92,6 +237,12 @@ def ometif2hdf5(
     out_filepath: str,
     names_filepath: str = None,
     overwrite: bool = True,
+    chunk_size: int = 256,
+    compression: str = None,
+    compression_opts: typing.Any = None,
+    num_workers: int = None,
+    memory_limit: int = 2 ** 30,
+    metrics: Metrics = None,
 ):
     """
     Convert ome.tif file into HDF5 file.
@@ -101,33 +252,87 @@ def ometif2hdf5(
             Input ome.tif file path.
         out_filepath: str
             Output .h5 file path.
-        name_filepath: str [optional]
+        names_filepath: str [optional]
             Text file with each line the name of the channels. Default None.
             If None, as increasing numbers like 1, 2, 3, ...
         overwrite: bool [optional]
             Overwrite output folder if already exists. Default True.
+        chunk_size: int [optional]
+            Edge length of the square HDF5 chunks. Default 256, which keeps
+            the mini-tiles and cell crops read by measure and exemplar
+            within a few chunks. If None, datasets are contiguous.
+        compression: str [optional]
+            HDF5 filter such as "gzip" or "lzf". Default None.
+        compression_opts: [optional]
+            Options for the compression filter, ex. gzip level. Default None.
+        num_workers: int [optional]
+            Channels decoded concurrently. Default None, as many as
+            available CPUs.
+        memory_limit: int [optional]
+            Bytes of decoded pixels allowed in flight, caps num_workers.
+            Default 1 GiB.
+        metrics: pcatk.metrics.Metrics [optional]
+            Sink for per-channel timings, bytes read and written, tile
+            throughput and pool utilization. Default None, not recorded.
     """
     # preprocessing
+    if metrics is None:
+        metrics = null_metrics
     in_filepath = Path(in_filepath)
     out_filepath = Path(out_filepath)
-    names_filepath = Path(names_filepath)
     check_overwrite(overwrite=overwrite, path=out_filepath)
 
     # load marker name
     if names_filepath is None:
         name_list = name_generator(start=1, step=1)
     else:
-        name_list = names_filepath.read_text().splitlines()
+        name_list = Path(names_filepath).read_text().splitlines()
         name_list = uniquify(name_list)
 
-    # automatic chunk size estimation
+    import h5py
+
+    # datasets are created upfront and filled tile by tile
     with tifffile.TiffFile(in_filepath) as tif, h5py.File(out_filepath, "w") as out_f:
-        for name, pg in zip(name_list, tif.series[0].pages):
-            out_f.create_dataset(name=name, data=pg.asarray())
+        pages = tif.series[0].pages
+        num_workers = channel_workers(pages[0], num_workers, memory_limit)
+        dataset_list = []
+        for name, pg in zip(name_list, pages):
+            shape = pg.keyframe.shape
+            if chunk_size is None:
+                chunks = None
+            else:
+                chunks = (min(chunk_size, shape[0]), min(chunk_size, shape[1]))
+            dataset = out_f.create_dataset(
+                name=name,
+                shape=shape,
+                dtype=pg.keyframe.dtype,
+                chunks=chunks,
+                compression=compression,
+                compression_opts=compression_opts,
+            )
+            dataset_list.append(dataset)
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+            futures = [
+                executor.submit(_page2hdf5, in_filepath, i, dataset, metrics)
+                for i, dataset in enumerate(dataset_list)
+            ]
+            _record_pool(metrics, "ometif2hdf5", num_workers, futures, start)
 
 
 def tif2ometif(
-    in_folderpath: str, out_filepath: str, tile_size: int = 1024, overwrite: bool = True
+    in_folderpath: str,
+    out_filepath: str,
+    tile_size: int = 1024,
+    overwrite: bool = True,
+    num_workers: int = None,
+    memory_limit: int = 2 ** 32,
+    metrics: Metrics = None,
+    compression: typing.Any = None,
+    predictor: bool = False,
+    subifds: bool = False,
+    verbose: bool = True,
+    scratch_dir: str = None,
 ):
     """
     Concatenate channels and make pyramid.
@@ -141,25 +346,552 @@ def tif2ometif(
             Tile size lower cap for ashlar pyramid generator. Default 1024.
         overwrite: bool [optional]
             Overwrite flag, default True.
+        num_workers: int [optional]
+            Processes downsampling channels in parallel. Default None, as
+            many as available CPUs.
+        memory_limit: int [optional]
+            Bytes of level-0 images kept in flight for downsampling.
+            Default 4 GiB.
+        metrics: pcatk.metrics.Metrics [optional]
+            Sink for decode, reduce and encode timings, bytes written, tile
+            throughput and pool utilization. Default None, not recorded.
+        compression: str [optional]
+            Tile compression, ex. "zlib", or "lzw" and "zstd" with
+            imagecodecs installed. Tiles are encoded by num_workers
+            threads. Default None, uncompressed.
+        predictor: bool [optional]
+            Apply horizontal differencing before compression, which helps
+            on smooth images. Default False.
+        subifds: bool [optional]
+            Store reduced levels as SubIFDs of their full resolution page,
+            as in the OME-TIFF pyramid specification, instead of as
+            additional images. Default False.
+        verbose: bool [optional]
+            Print the progress of the pyramid generator. Default True.
+        scratch_dir: str [optional]
+            Folder for the reduced levels kept on disk until written, about
+            a third of the output size. Default None, the output folder.
     """
     # preprocessing
+    if metrics is None:
+        metrics = null_metrics
     in_folderpath = Path(in_folderpath)
     out_filepath = Path(out_filepath)
     check_overwrite(overwrite=overwrite, path=out_filepath)
+    if scratch_dir is None:
+        scratch_dir = out_filepath.parent
+    path_list = sorted(in_folderpath.iterdir())
 
-    # make generators
+    # images are loaded one at a time as the pyramid generator consumes them
     def arr_gen():
-        for x in in_folderpath.iterdir():
-            yield tifffile.imread(x)
-
-    def name_gen():
-        for x in in_folderpath.iterdir():
-            yield x.stem
+        for i, x in enumerate(path_list):
+            with metrics.timer("decode", channel=i) as timer:
+                img = tifffile.imread(x)
+                timer.update(bytes_read=x.stat().st_size)
+            yield img
 
     # pass to ashlar pyramid generator
-    ashlar_pyramid.main(
+    ashlar_pyramid.build_pyramid(
         array_list=arr_gen(),
-        channel_name_list=name_gen(),
-        out_path=out_filepath,
+        channel_name_list=[x.stem for x in path_list],
+        out_path=str(out_filepath),
+        tile_size=tile_size,
+        num_workers=num_workers,
+        memory_limit=memory_limit,
+        metrics=metrics,
+        verbose=verbose,
+        scratch_dir=str(scratch_dir),
+        compression=compression,
+        predictor=predictor,
+        subifds=subifds,
+    )
+
+
+def ome_channel_names(tif: tifffile.TiffFile) -> typing.List[str]:
+    """
+    Channel names of the first image in the OME-XML of a file.
+
+    Args:
+        tif: tifffile.TiffFile
+            Opened ome.tif file.
+
+    Return: list of str, numbered from 1 for channels without a name.
+    """
+    num_channels = len(level_pages(tif, 0))
+    name_list = [str(i + 1) for i in range(num_channels)]
+    if tif.ome_metadata:
+        root = ET.fromstring(tif.ome_metadata)
+        ns = {"ome": root.tag.split("}")[0].strip("{")}
+        channel_list = root.findall("ome:Image/ome:Pixels", ns)[0].findall(
+            "ome:Channel", ns
+        )
+        for i, channel in enumerate(channel_list[:num_channels]):
+            name_list[i] = channel.get("Name", name_list[i])
+    return name_list
+
+
+def ome_pixel_size(tif: tifffile.TiffFile) -> typing.Optional[float]:
+    """
+    Physical pixel size along x of the first image in the OME-XML of a file.
+
+    Args:
+        tif: tifffile.TiffFile
+            Opened ome.tif file.
+
+    Return: float, or None if not recorded.
+    """
+    if not tif.ome_metadata:
+        return None
+    root = ET.fromstring(tif.ome_metadata)
+    ns = {"ome": root.tag.split("}")[0].strip("{")}
+    pixels = root.find("ome:Image/ome:Pixels", ns)
+    if pixels is None or pixels.get("PhysicalSizeX") is None:
+        return None
+    return float(pixels.get("PhysicalSizeX"))
+
+
+def ometif2roi(
+    in_filepath: str,
+    roi_dict: typing.Dict[str, typing.Tuple[int, int, int, int]],
+    out_folderpath: str,
+    level: int = 0,
+    tile_size: int = 1024,
+    overwrite: bool = True,
+    num_workers: int = None,
+    metrics: Metrics = None,
+    compression: typing.Any = None,
+    predictor: bool = False,
+    subifds: bool = False,
+    verbose: bool = True,
+    scratch_dir: str = None,
+):
+    """
+    Cut regions of interest out of an ome.tif file, each into its own
+    pyramidal ome.tif. Only the tiles overlapping the regions are read, in
+    one pass over the file for all regions. Outputs record the pixel size
+    of the input at the selected level.
+
+    Args:
+        in_filepath: str
+            Input ome.tif file path.
+        roi_dict: dict of str -> tuple of int
+            Output name -> (xl, xu, yl, yu), the region img[xl:xu, yl:yu]
+            in pixels of the selected level. Regions are clipped to the
+            image; a region empty after clipping raises ValueError.
+        out_folderpath: str
+            Output folder, regions are saved as {name}.ome.tif.
+        level: int [optional]
+            Pyramid level to cut from, 0 being full resolution. Default 0.
+        tile_size: int [optional]
+            Tile size lower cap for ashlar pyramid generator. Default 1024.
+        overwrite: bool [optional]
+            Overwrite output folder if already exists. Default True.
+        num_workers: int [optional]
+            Channels read concurrently, also passed to the pyramid generator.
+            Default None, as many as available CPUs.
+        metrics: pcatk.metrics.Metrics [optional]
+            Sink for per-channel read timings and the records of the pyramid
+            generator. Default None, not recorded.
+        compression, predictor, subifds: [optional]
+            Output layout, see tif2ometif.
+        verbose: bool [optional]
+            Print pyramid progress, see tif2ometif. Default True.
+        scratch_dir: str [optional]
+            Folder for reduced levels, see tif2ometif. Default None, the
+            output folder.
+    """
+    # preprocessing
+    if metrics is None:
+        metrics = null_metrics
+    in_filepath = Path(in_filepath)
+    out_folderpath = Path(out_folderpath)
+    with tifffile.TiffFile(in_filepath) as tif:
+        name_list = ome_channel_names(tif)
+        num_channels = len(name_list)
+        shape = level_pages(tif, level)[0].keyframe.shape
+        pixel_size = ome_pixel_size(tif)
+    # pixels of reduced levels are 2 ** level times as large
+    pixel_size = (0.325 if pixel_size is None else pixel_size) * 2 ** level
+    roi_list = list(roi_dict)
+    region_list = []
+    for roi, (xl, xu, yl, yu) in roi_dict.items():
+        xl, yl = max(0, xl), max(0, yl)
+        xu, yu = min(xu, shape[0]), min(yu, shape[1])
+        if xl >= xu or yl >= yu:
+            raise ValueError(f"ROI {roi} is empty within image of shape {shape}")
+        region_list.append((slice(xl, xu), slice(yl, yu)))
+    check_overwrite(overwrite=overwrite, path=out_folderpath)
+    out_folderpath.mkdir(parents=True, exist_ok=True)
+    if scratch_dir is None:
+        scratch_dir = out_folderpath
+    if num_workers is None:
+        num_workers = default_num_workers()
+
+    def read_channel(index):
+        # each worker has its own file handle, see _page2tif
+        with tifffile.TiffFile(in_filepath) as tif, metrics.timer(
+            "decode", level=level, channel=index
+        ) as timer:
+            pg = level_pages(tif, level)[index]
+            memmap = segment_memmap(pg)
+            if memmap is not None:
+                region_images = [np.array(memmap[region]) for region in region_list]
+            else:
+                region_images = read_regions(pg, region_list)
+            timer.update(bytes_decoded=sum(img.nbytes for img in region_images))
+        return region_images, timer.seconds
+
+    # roi -> list of channel images
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+        result_list = list(executor.map(read_channel, range(num_channels)))
+    channel_list = [region_images for region_images, _ in result_list]
+    if metrics.enabled:
+        busy = sum(seconds for _, seconds in result_list)
+        metrics.pool("ometif2roi", num_workers, busy, time.perf_counter() - start)
+    del result_list
+    image_dict = {
+        roi: [channel[k] for channel in channel_list] for k, roi in enumerate(roi_list)
+    }
+    del channel_list
+
+    for roi in roi_list:
+        array_list = image_dict.pop(roi)
+        ashlar_pyramid.build_pyramid(
+            array_list=array_list,
+            channel_name_list=name_list,
+            out_path=str(out_folderpath / f"{roi}.ome.tif"),
+            tile_size=tile_size,
+            num_workers=num_workers,
+            metrics=metrics,
+            verbose=verbose,
+            scratch_dir=str(scratch_dir),
+            pixel_size=pixel_size,
+            compression=compression,
+            predictor=predictor,
+            subifds=subifds,
+        )
+
+
+def ometif_add_channels(
+    in_filepath: str,
+    channel_dict: typing.Dict[str, typing.Union[str, np.ndarray]],
+    out_filepath: str = None,
+    overwrite: bool = True,
+    metrics: Metrics = None,
+    verbose: bool = True,
+    scratch_dir: str = None,
+):
+    """
+    Append channels to, or replace channels of, an existing pyramidal ome.tif
+    file. Only the given channels are downsampled and encoded; the encoded
+    tiles of every other channel and level are copied as they are. The tile
+    size, compression and level layout of the input are kept.
+
+    Args:
+        in_filepath: str
+            Input ome.tif file path, ex. made by tif2ometif.
+        channel_dict: dict of str -> str or np.ndarray
+            Channel name -> TIFF image path or full resolution image. Names
+            already in the file replace that channel in place, new names are
+            appended in order.
+        out_filepath: str [optional]
+            Output ome.tif file path. Default None, update the input file,
+            which is swapped for the new file only once it is complete.
+        overwrite: bool [optional]
+            Overwrite output file if already exists. Default True.
+        metrics: pcatk.metrics.Metrics [optional]
+            Sink for reduce and encode timings, bytes written and tile
+            throughput. Default None, not recorded.
+        verbose: bool [optional]
+            Print the progress of each channel written. Default True.
+        scratch_dir: str [optional]
+            Folder for the reduced levels of new channels. Default None,
+            the folder of the output file.
+    """
+    # preprocessing
+    in_filepath = Path(in_filepath)
+    if out_filepath is None:
+        out_filepath = in_filepath
+    else:
+        out_filepath = Path(out_filepath)
+        check_overwrite(overwrite=overwrite, path=out_filepath)
+    tmp_filepath = out_filepath.with_name(f".{out_filepath.name}.tmp")
+    check_overwrite(overwrite=True, path=tmp_filepath)
+    if scratch_dir is None:
+        scratch_dir = out_filepath.parent
+
+    with tifffile.TiffFile(in_filepath) as tif:
+        name_list = ome_channel_names(tif)
+        pixel_size = ome_pixel_size(tif)
+    # existing channels are referred to by index, new ones by image
+    channel_list = list(range(len(name_list)))
+    for name, image in channel_dict.items():
+        image = str(image) if isinstance(image, Path) else image
+        if name in name_list:
+            channel_list[name_list.index(name)] = image
+        else:
+            name_list.append(name)
+            channel_list.append(image)
+
+    try:
+        ashlar_pyramid.update_pyramid(
+            in_path=str(in_filepath),
+            channel_list=channel_list,
+            channel_name_list=name_list,
+            out_path=str(tmp_filepath),
+            pixel_size=0.325 if pixel_size is None else pixel_size,
+            filename=out_filepath.name,
+            metrics=metrics,
+            verbose=verbose,
+            scratch_dir=str(scratch_dir),
+        )
+    except BaseException:
+        tmp_filepath.unlink(missing_ok=True)
+        raise
+    tmp_filepath.replace(out_filepath)
+
+
+def _ngff_axes(multiscale: dict) -> typing.List[str]:
+    # axes are a list of names in OME-NGFF v0.3 and of dicts from v0.4
+    axes = multiscale.get("axes", ["t", "c", "z", "y", "x"])
+    return [a["name"] if isinstance(a, dict) else a for a in axes]
+
+
+def _ngff_pixel_size(multiscale: dict, level: int = 0) -> typing.Optional[float]:
+    # scale along x of a level, composed with that of the whole multiscale
+    pixel_size = None
+    x = _ngff_axes(multiscale).index("x")
+    for item in [multiscale["datasets"][level], multiscale]:
+        for transform in item.get("coordinateTransformations", []):
+            if transform.get("type") == "scale":
+                pixel_size = (pixel_size or 1.0) * transform["scale"][x]
+    return pixel_size
+
+
+def ometif2zarr(
+    in_filepath: str,
+    out_filepath: str,
+    chunk_size: int = 1024,
+    overwrite: bool = True,
+    compressor: typing.Any = "default",
+    num_workers: int = None,
+    metrics: Metrics = None,
+):
+    """
+    Convert ome.tif file into a multiscale OME-NGFF (v0.4) zarr store, with
+    one (c, y, x) array per pyramid level. Chunks are square within a single
+    channel and are written concurrently, so the store can later be read
+    and written tile by tile from many processes. Reduced levels are
+    downsampled as in tif2ometif.
+
+    Args:
+        in_filepath: str
+            Input ome.tif file path.
+        out_filepath: str
+            Output .zarr folder path.
+        chunk_size: int [optional]
+            Edge length of the square chunks, also the size the smallest
+            level fits in. Default 1024.
+        overwrite: bool [optional]
+            Overwrite output folder if already exists. Default True.
+        compressor: numcodecs codec [optional]
+            Chunk compressor. Default "default", zarr's default. If None,
+            chunks are uncompressed.
+        num_workers: int [optional]
+            Threads reading, downsampling and writing chunks. Default None,
+            as many as available CPUs.
+        metrics: pcatk.metrics.Metrics [optional]
+            Sink for per-level timings and tile throughput. Default None,
+            not recorded.
+    """
+    import zarr
+
+    # preprocessing
+    if metrics is None:
+        metrics = null_metrics
+    if num_workers is None:
+        num_workers = default_num_workers()
+    in_filepath = Path(in_filepath)
+    out_filepath = Path(out_filepath)
+    check_overwrite(overwrite=overwrite, path=out_filepath)
+
+    with tifffile.TiffFile(in_filepath) as tif:
+        name_list = ome_channel_names(tif)
+        pixel_size = ome_pixel_size(tif) or 1.0
+    channel_list = [TiffArray(in_filepath, channel=c) for c in range(len(name_list))]
+    shapes = ashlar_pyramid.level_shapes(channel_list[0].shape, chunk_size)
+    dtype = channel_list[0].dtype
+
+    root = zarr.open_group(str(out_filepath), mode="w")
+    level_list = [
+        root.create_dataset(
+            str(level),
+            shape=(len(name_list),) + tuple(map(int, shape)),
+            chunks=(1, chunk_size, chunk_size),
+            dtype=dtype,
+            compressor=compressor,
+        )
+        for level, shape in enumerate(shapes)
+    ]
+
+    # each task writes one row of whole chunks, so no chunk is shared
+    def copy_band(args):
+        c, y = args
+        level_list[0][c, y : y + chunk_size] = channel_list[c][y : y + chunk_size]
+
+    def reduce_band(args):
+        level, c, y = args
+        band = level_list[level - 1][c, 2 * y : 2 * (y + chunk_size)]
+        level_list[level][c, y : y + chunk_size] = ashlar_pyramid.reduce2(band)
+
+    with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+        for level, shape in enumerate(shapes):
+            tiles = len(name_list) * ashlar_pyramid.num_tiles(shape, chunk_size)
+            with metrics.timer("encode", level=level, tiles=tiles):
+                bands = range(0, shape[0], chunk_size)
+                if level == 0:
+                    task_list = [(c, y) for c in range(len(name_list)) for y in bands]
+                    list(executor.map(copy_band, task_list))
+                else:
+                    task_list = [
+                        (level, c, y) for c in range(len(name_list)) for y in bands
+                    ]
+                    list(executor.map(reduce_band, task_list))
+    for channel in channel_list:
+        channel.close()
+
+    root.attrs["multiscales"] = [
+        {
+            "version": "0.4",
+            "name": in_filepath.name,
+            "axes": [
+                {"name": "c", "type": "channel"},
+                {"name": "y", "type": "space", "unit": "micrometer"},
+                {"name": "x", "type": "space", "unit": "micrometer"},
+            ],
+            "datasets": [
+                {
+                    "path": str(level),
+                    "coordinateTransformations": [
+                        {
+                            "type": "scale",
+                            "scale": [1.0] + [pixel_size * 2 ** level] * 2,
+                        }
+                    ],
+                }
+                for level in range(len(shapes))
+            ],
+            "type": "mean",
+        }
+    ]
+    root.attrs["omero"] = {
+        "version": "0.4",
+        "channels": [{"label": name, "active": True} for name in name_list],
+    }
+
+
+def zarr_channels(in_filepath: str, level: int = 0) -> typing.Dict[str, ChannelArray]:
+    """
+    Lazy channel images of an OME-NGFF zarr store, ex. made by ometif2zarr,
+    to pass to measure, feature and exemplar functions. Each is read chunk
+    by chunk as it is sliced.
+
+    Args:
+        in_filepath: str
+            Input .zarr folder path.
+        level: int [optional]
+            Pyramid level, 0 being full resolution. Default 0.
+
+    Return: dict of str -> util.ChannelArray
+        Channel name -> 2-D lazy image, in channel order. Channels without
+        a label are numbered from 1, and duplicate names made unique with
+        uniquify.
+    """
+    import zarr
+
+    root = zarr.open_group(str(in_filepath), mode="r")
+    multiscale = root.attrs["multiscales"][0]
+    axes = _ngff_axes(multiscale)
+    array = root[multiscale["datasets"][level]["path"]]
+    if axes[-2:] != ["y", "x"] or any(
+        array.shape[i] != 1 for i, a in enumerate(axes[:-2]) if a != "c"
+    ):
+        raise ValueError(f"{in_filepath}: expected a single 2-D plane per channel")
+    num_channels = array.shape[axes.index("c")] if "c" in axes else 1
+    label_list = [
+        channel.get("label")
+        for channel in root.attrs.get("omero", {}).get("channels", [])
+    ]
+    name_list = uniquify(
+        [
+            label_list[c] if c < len(label_list) and label_list[c] else str(c + 1)
+            for c in range(num_channels)
+        ]
+    )
+    channel_dict = {}
+    for c, name in enumerate(name_list):
+        index = tuple(c if a == "c" else 0 for a in axes[:-2])
+        channel_dict[name] = ChannelArray(array, index)
+    return channel_dict
+
+
+def zarr2ometif(
+    in_filepath: str,
+    out_filepath: str,
+    tile_size: int = 1024,
+    overwrite: bool = True,
+    num_workers: int = None,
+    memory_limit: int = 2 ** 32,
+    metrics: Metrics = None,
+    compression: typing.Any = None,
+    predictor: bool = False,
+    subifds: bool = False,
+    verbose: bool = True,
+    scratch_dir: str = None,
+):
+    """
+    Convert the full resolution level of an OME-NGFF zarr store into a
+    pyramidal ome.tif file, keeping its channel names and pixel size.
+
+    Args:
+        in_filepath: str
+            Input .zarr folder path.
+        out_filepath: str
+            Output ome.tif file path.
+        tile_size, num_workers, memory_limit, metrics: [optional]
+            See tif2ometif.
+        verbose, scratch_dir: [optional]
+            See tif2ometif. scratch_dir defaults to the output folder.
+        overwrite: bool [optional]
+            Overwrite flag, default True.
+        compression, predictor, subifds: [optional]
+            Output layout, see tif2ometif.
+    """
+    import zarr
+
+    # preprocessing
+    out_filepath = Path(out_filepath)
+    check_overwrite(overwrite=overwrite, path=out_filepath)
+    if scratch_dir is None:
+        scratch_dir = out_filepath.parent
+    channel_dict = zarr_channels(in_filepath)
+    root = zarr.open_group(str(in_filepath), mode="r")
+    pixel_size = _ngff_pixel_size(root.attrs["multiscales"][0])
+
+    # channels are loaded one at a time as the pyramid generator consumes them
+    ashlar_pyramid.build_pyramid(
+        array_list=(np.asarray(image) for image in channel_dict.values()),
+        channel_name_list=list(channel_dict),
+        out_path=str(out_filepath),
         tile_size=tile_size,
+        num_workers=num_workers,
+        memory_limit=memory_limit,
+        metrics=metrics,
+        verbose=verbose,
+        scratch_dir=str(scratch_dir),
+        pixel_size=0.325 if pixel_size is None else pixel_size,
+        compression=compression,
+        predictor=predictor,
+        subifds=subifds,
     )
@@ -1,48 +1,253 @@
+import os
+import uuid
 import typing
+import collections
+import concurrent.futures
 from pathlib import Path
 
 import numpy as np
-import skimage.io as sio
-import matplotlib.colors as mcolors
+import tifffile
 
-from skimage.measure import regionprops_table
-from skimage import img_as_float, img_as_ubyte
-
-from .util import check_overwrite
+from .util import (
+    TiffArray,
+    aligned_tile_shape,
+    check_overwrite,
+    default_num_workers,
+    read_crops,
+    tile_regions,
+)
+from .cache import DiskCache, resolve
 
 
 Slice = typing.Tuple[slice, slice]
 
 
+def index_filepath_of(mask: typing.Any) -> typing.Optional[Path]:
+    """
+    Default location of the cell index saved next to a mask file.
+
+    Args:
+        mask: util.TiffArray or h5py.Dataset
+            Mask backed by a file.
+
+    Return: pathlib.Path, or None for masks not backed by a file.
+    """
+    if isinstance(mask, TiffArray):
+        if mask.level == 0 and mask.channel == 0:
+            return Path(f"{mask.path}.cells.npz")
+        return Path(f"{mask.path}.{mask.level}.{mask.channel}.cells.npz")
+    if hasattr(mask, "file") and hasattr(mask, "name"):
+        # h5py.Dataset
+        return Path(f"{mask.file.filename}{mask.name.replace('/', '.')}.cells.npz")
+    return None
+
+
+def _save_index(index_filepath: Path, props: typing.Dict[str, np.ndarray]) -> bool:
+    # written under a temporary name and renamed, so readers never see a
+    # partial file; False if the folder is not writable
+    tmp_filepath = index_filepath.with_name(
+        f".{index_filepath.name}.{uuid.uuid4().hex}.tmp"
+    )
+    try:
+        with open(tmp_filepath, "wb") as f:
+            np.savez(f, **props)
+        os.replace(tmp_filepath, index_filepath)
+    except OSError:
+        try:
+            tmp_filepath.unlink()
+        except OSError:
+            pass
+        return False
+    return True
+
+
+def index_cells(
+    mask: np.ndarray,
+    block_size: int = 4096,
+    index_filepath: str = None,
+    num_workers: int = None,
+    cache: typing.Union[bool, DiskCache] = True,
+) -> typing.Dict[str, np.ndarray]:
+    """
+    Index cell area, centroid and bounding box in one tiled pass over the
+    mask. The index is saved next to file-backed masks and reused as long
+    as it is newer than the mask file. Other masks are looked up in the
+    cache by content.
+
+    Args:
+        mask: np.ndarray
+            Mask image, or anything sliceable like it such as h5py.Dataset,
+            np.memmap, or util.TiffArray. A str is opened as TIFF file.
+        block_size: int [optional]
+            Edge length of mask tiles read at a time, rounded to whole
+            storage chunks of chunked masks. Default 4096.
+        index_filepath: str [optional]
+            Where to save and load the index. Default None, next to the
+            mask file if there is one, else not saved.
+        num_workers: int [optional]
+            Threads indexing tiles. Default None, as many as available CPUs.
+        cache: bool or cache.DiskCache [optional]
+            Cache for indices that cannot be saved to index_filepath, such
+            as those of masks in memory or in read-only folders. Default
+            True, the default cache.
+
+    Return: dict of str -> np.ndarray
+        Same keys as skimage.measure.regionprops_table with properties
+        label, area, centroid and bbox.
+    """
+    # preprocessing
+    if isinstance(mask, (str, Path)):
+        mask = TiffArray(mask)
+    if index_filepath is None:
+        index_filepath = index_filepath_of(mask)
+    else:
+        index_filepath = Path(index_filepath)
+    if isinstance(mask, TiffArray):
+        source_filepath = mask.path
+    elif index_filepath_of(mask) is not None:
+        source_filepath = mask.file.filename
+    else:
+        source_filepath = None
+
+    # reuse saved index unless the mask changed since
+    if index_filepath is not None and index_filepath.is_file():
+        if source_filepath is None or (
+            os.path.getmtime(source_filepath) <= os.path.getmtime(index_filepath)
+        ):
+            with np.load(index_filepath) as f:
+                return {key: f[key] for key in f.files}
+    cache = resolve(cache)
+    if cache is not None:
+        cache_key = cache.key("index_cells", mask)
+        entry = cache.get(cache_key)
+        if entry is not None:
+            return {key: np.array(value) for key, value in entry.items()}
+
+    def index_tile(region):
+        y, x = region[0].start, region[1].start
+        tile = np.asarray(mask[region])
+        rr, cc = np.nonzero(tile)
+        label = tile[rr, cc]
+        if label.size == 0:
+            return label, None
+        # stable sort keeps rows ascending within each label
+        order = np.argsort(label, kind="stable")
+        label, rr, cc = label[order], rr[order] + y, cc[order] + x
+        start = np.flatnonzero(np.r_[True, label[1:] != label[:-1]])
+        end = np.r_[start[1:], label.size]
+        stats = np.stack(
+            [
+                end - start,
+                np.add.reduceat(rr, start),
+                np.add.reduceat(cc, start),
+                rr[start],
+                np.minimum.reduceat(cc, start),
+                rr[end - 1],
+                np.maximum.reduceat(cc, start),
+            ]
+        )
+        return label[start], stats
+
+    if num_workers is None:
+        num_workers = default_num_workers()
+    region_list = tile_regions(mask.shape, aligned_tile_shape([mask], block_size))
+    # rows: area, row sum, column sum, bbox min row/col, bbox max row/col
+    acc = np.zeros((7, 0), dtype=np.int64)
+    with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+        for label, stats in executor.map(index_tile, region_list):
+            if label.size == 0:
+                continue
+            if label[-1] >= acc.shape[1]:
+                grown = np.zeros((7, label[-1] + 1), dtype=np.int64)
+                grown[3:5] = np.iinfo(np.int64).max
+                grown[:, : acc.shape[1]] = acc
+                acc = grown
+            acc[:3, label] += stats[:3]
+            acc[3:5, label] = np.minimum(acc[3:5, label], stats[3:5])
+            acc[5:7, label] = np.maximum(acc[5:7, label], stats[5:7])
+
+    label = np.flatnonzero(acc[0])
+    props = {
+        "label": label,
+        "area": acc[0, label],
+        "centroid-0": acc[1, label] / acc[0, label],
+        "centroid-1": acc[2, label] / acc[0, label],
+        "bbox-0": acc[3, label],
+        "bbox-1": acc[4, label],
+        "bbox-2": acc[5, label] + 1,
+        "bbox-3": acc[6, label] + 1,
+    }
+    if index_filepath is not None and _save_index(index_filepath, props):
+        return props
+    if cache is not None:
+        cache.put(cache_key, **props)
+    return props
+
+
 def sample(
-    mask: np.ndarray, tile_size: typing.Tuple[int, int], size: int
+    mask: np.ndarray,
+    tile_size: typing.Tuple[int, int],
+    size: int,
+    seed: int = None,
+    strata: typing.Mapping[int, typing.Hashable] = None,
+    index_filepath: str = None,
 ) -> typing.Dict[int, Slice]:
     """
     Sample cells.
 
     Args:
         mask: np.ndarray
-            Mask image for skimage.feature.regionprops
+            Mask image, or anything accepted by index_cells.
         tile_size: tuple of int
             Crop size for individual cells.
         size: int
             Sample size.
+        seed: int [optional]
+            Seed of the random generator for reproducible samples.
+            Default None.
+        strata: mapping of int -> hashable [optional]
+            Group of each cell label, ex. cluster id. If given, sample size
+            cells from each group, or all of a group if it has fewer cells.
+            Cells without a group are not sampled. Default None.
+        index_filepath: str [optional]
+            Cell index location, see index_cells. Default None.
 
     Return: dict of label -> tuple of slice objects
     """
+    if isinstance(mask, (str, Path)):
+        mask = TiffArray(mask)
+    props = index_cells(mask, index_filepath=index_filepath)
     # filter out cells at boundary
-    props = regionprops_table(mask, properties=["label", "centroid"])
-    mask = (
+    inside = (
         (props["centroid-0"] > tile_size[0])
         & (props["centroid-0"] < mask.shape[0] - tile_size[0])
         & (props["centroid-1"] > tile_size[1])
         & (props["centroid-1"] < mask.shape[1] - tile_size[1])
     )
     for key in props:
-        props[key] = props[key][mask]
+        props[key] = props[key][inside]
     # sampling
+    rng = np.random.default_rng(seed)
     count = props["label"].shape[0]
-    index = np.random.choice(range(count), size=size, replace=False)
+    if strata is None:
+        index = rng.choice(count, size=size, replace=False)
+    else:
+        # look up group of each cell through sorted labels
+        keys = np.fromiter(strata.keys(), dtype=np.int64, count=len(strata))
+        groups = np.array(list(strata.values()) + [None], dtype=object)
+        order = np.argsort(keys)
+        keys, groups[:-1] = keys[order], groups[:-1][order]
+        pos = np.searchsorted(keys, props["label"])
+        found = pos < keys.size
+        found[found] = keys[pos[found]] == props["label"][found]
+        cell_groups = groups[np.where(found, pos, keys.size)]
+        index_list = [np.zeros(0, dtype=int)]
+        for group in dict.fromkeys(groups[:-1]):
+            member = np.flatnonzero(found & (cell_groups == group))
+            index_list.append(
+                rng.choice(member, size=min(size, member.size), replace=False)
+            )
+        index = np.sort(np.concatenate(index_list))
     for key in props:
         props[key] = props[key][index]
     # make slice output
@@ -51,7 +256,7 @@ def sample(
     xu, yu = xl + tile_size[0], yl + tile_size[1]
     out_dict = {
         props["label"][i]: (slice(xl[i], xu[i]), slice(yl[i], yu[i]))
-        for i in range(size)
+        for i in range(props["label"].shape[0])
     }
 
     return out_dict
@@ -69,10 +274,12 @@ def project2rgb(image: np.ndarray, color: str) -> np.ndarray:
 
     Return: np.ndarray of shape (N, M, 3)
     """
-    out = color.gray2rgb(img_as_float(image))
+    import matplotlib.colors as mcolors
+    from skimage import img_as_float
+
     rgb_code = mcolors.to_rgb(color)
 
-    return out * np.array(rgb_code)
+    return img_as_float(image)[..., np.newaxis] * np.array(rgb_code)
 
 
 def render(
@@ -80,6 +287,8 @@ def render(
     image_dict: typing.Dict[str, np.ndarray],
     out_folderpath: str,
     overwrite: bool = True,
+    num_workers: int = None,
+    tile_size: int = 1024,
 ):
     """
     Render sampled cells.
@@ -88,27 +297,58 @@ def render(
         slice_dict: dict of integer --> tuple of slice object.
             Output of sample function.
         image_dict: dict of str --> np.ndarray
-            Key is matplotlib named color. Value is image as np.ndarray.
+            Key is matplotlib named color. Value is image as np.ndarray, or
+            anything sliceable like it such as h5py.Dataset, util.TiffArray
+            or a dask array. Only the crops of the cells are read.
         out_folderpath: str
             Folder to save rendered figures.
         overwrite: bool [optional]
             Overwrite flag, default True.
+        num_workers: int [optional]
+            Threads reading, compositing and saving cells. Default None, as
+            many as available CPUs.
+        tile_size: int [optional]
+            Cells starting in the same tile of this size, rounded to whole
+            storage chunks, are read together so each chunk is read once.
+            Default 1024.
     """
     # preprocessing
     out_folderpath = Path(out_folderpath)
     check_overwrite(overwrite=overwrite, path=out_folderpath)
+    out_folderpath.mkdir(parents=True, exist_ok=True)
+    if num_workers is None:
+        num_workers = default_num_workers()
 
-    # not much memory optimization done for now
-    # if memory is an issue, pass h5py.Dataset instead of np.ndarray
-    # code below is compatible with h5py.Dataset
-    for key in slice_dict:
-        arr = np.stack(
-            [project2rgb(image, color) for color, image in image_dict.items()], axis=0
+    import skimage.io as sio
+    import matplotlib.colors as mcolors
+    from skimage import img_as_float, img_as_ubyte
+
+    # shape (channel, 1, 1, RGB) to broadcast against stacked crops
+    rgb_codes = np.array([mcolors.to_rgb(color) for color in image_dict])
+    rgb_codes = rgb_codes[:, np.newaxis, np.newaxis, :]
+    image_list = list(image_dict.values())
+    tile_shape = aligned_tile_shape(image_list, tile_size)
+    group_dict = collections.defaultdict(list)
+    for key, (rows, cols) in slice_dict.items():
+        origin = (
+            (rows.start or 0) // tile_shape[0],
+            (cols.start or 0) // tile_shape[1],
         )
-        arr = arr.max(axis=0)
-        arr = img_as_ubyte(arr)
-        out_filepath = out_folderpath / f"{key}.png"
-        sio.imsave(out_filepath, arr)
+        group_dict[origin].append(key)
+
+    def render_group(key_list):
+        region_list = [slice_dict[key] for key in key_list]
+        crop_list = [read_crops(image, region_list) for image in image_list]
+        for i, key in enumerate(key_list):
+            crop = np.stack([img_as_float(crops[i]) for crops in crop_list])
+            arr = (crop[..., np.newaxis] * rgb_codes).max(axis=0)
+            arr = img_as_ubyte(arr)
+            out_filepath = out_folderpath / f"{key}.png"
+            sio.imsave(out_filepath, arr)
+
+    with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+        for _ in executor.map(render_group, group_dict.values()):
+            pass
 
 
 def assemble(
@@ -117,48 +357,95 @@ def assemble(
     shape: typing.Tuple[int, int],
     pad_width: int = None,
     overwrite: bool = True,
+    tile_size: int = None,
+    num_workers: int = None,
 ):
     """
     Assemble images into exemplar, supports padding.
 
     Args:
         in_folderpath: str
-            Folder path of input images.
+            Folder path of input images, placed row by row in file name
+            order.
         out_filepath: str
             Output image path.
         shape: tuple of int
-            Mosaic shape, ex. (10, 10).
+            Mosaic shape as (rows, columns), ex. (10, 10).
         pad_width: int [optional]
             Padding as border. If None, no padding. Default None.
         overwrite: bool [optional]
             Overwrite flag, default True.
+        tile_size: int [optional]
+            If given, write a tiled TIFF with tiles of this size, one band
+            of tiles at a time, so the mosaic never has to fit in memory.
+            Default None, assemble in one preallocated image.
+        num_workers: int [optional]
+            Threads decoding images. Default None, as many as available
+            CPUs.
     """
     # preprocessing
     in_folderpath = Path(in_folderpath)
     out_filepath = Path(out_filepath)
-    check_overwrite(out_filepath)
+    check_overwrite(overwrite=overwrite, path=out_filepath)
+    if pad_width is None:
+        pad_width = 0
+    if num_workers is None:
+        num_workers = default_num_workers()
 
-    # if fewer image than needed, add blank images
-    image_list = [sio.imread(p) for p in in_folderpath.iterdir()]
+    import skimage.io as sio
+
+    # if fewer image than needed, the rest stays blank
     num_block = np.prod(shape)
-    if len(image_list) < num_block:
-        image_list.extend(
-            [np.ones_like(image_list[0]) for _ in range(num_block - len(image_list))]
-        )
+    path_list = sorted(in_folderpath.iterdir())[:num_block]
+    first = sio.imread(path_list[0])
+    image_h, image_w = first.shape[:2]
+    block_h, block_w = image_h + 2 * pad_width, image_w + 2 * pad_width
+    out_shape = (shape[0] * block_h, shape[1] * block_w) + first.shape[2:]
 
-    # add padding
-    if pad_width is not None:
-        image_list = [
-            np.pad(
-                image,
-                pad_width=(pad_width, pad_width, 0),
-                mode="constant",
-                constant_values=1,
-            )
-            for image in image_list
-        ]
+    def place(out, index, image, top=0):
+        # padding and blank blocks keep the fill value of one
+        row, col = divmod(index, shape[1])
+        y = row * block_h + pad_width - top
+        x = col * block_w + pad_width
+        out[y : y + image_h, x : x + image_w] = image
+
+    executor = concurrent.futures.ThreadPoolExecutor(num_workers)
+    with executor:
+        if tile_size is None:
+            out = np.ones(out_shape, dtype=first.dtype)
+            for index, image in enumerate(executor.map(sio.imread, path_list)):
+                place(out, index, image)
+            sio.imsave(out_filepath, out)
+            return
 
-    # assembling
-    image_list = [image_list[i:i + shape[0]] for i in range(0, num_block, shape[0])]
-    out = np.block(image_list)
-    sio.imsave(out_filepath, out)
+        def iter_tiles():
+            band = np.ones((0,) + out_shape[1:], dtype=first.dtype)
+            for row in range(shape[0]):
+                # decode one row of blocks, then emit every full band of tiles
+                strip = np.ones((block_h,) + out_shape[1:], dtype=first.dtype)
+                start = row * shape[1]
+                row_path_list = path_list[start : start + shape[1]]
+                image_list = executor.map(sio.imread, row_path_list)
+                for index, image in enumerate(image_list, start):
+                    place(strip, index, image, top=row * block_h)
+                band = np.concatenate([band, strip])
+                while band.shape[0] >= tile_size or (
+                    row == shape[0] - 1 and band.shape[0] > 0
+                ):
+                    for x in range(0, out_shape[1], tile_size):
+                        tile = np.ones(
+                            (tile_size, tile_size) + out_shape[2:], dtype=first.dtype
+                        )
+                        part = band[:tile_size, x : x + tile_size]
+                        tile[: part.shape[0], : part.shape[1]] = part
+                        yield tile
+                    band = band[tile_size:]
+
+        tifffile.imwrite(
+            out_filepath,
+            iter_tiles(),
+            shape=out_shape,
+            dtype=first.dtype,
+            tile=(tile_size, tile_size),
+            photometric="rgb" if len(out_shape) == 3 else "minisblack",
+        )
@@ -6,36 +6,74 @@ import os
 import re
 import io
 import struct
-import itertools
+import time
 import uuid
+import shutil
+import tempfile
 import multiprocessing
 import concurrent.futures
+from multiprocessing import shared_memory
 import numpy as np
-import skimage.io
 import tifffile
-import skimage.transform
-import pytiff
+
+from ..metrics import null_metrics
+
+
+def accumulator_dtype(dtype):
+    # wide enough to hold the sum of four pixels without overflow
+    dtype = np.dtype(dtype)
+    if dtype.kind == "u":
+        return np.uint32 if dtype.itemsize <= 2 else np.uint64
+    if dtype.kind in "ib":
+        return np.int32 if dtype.itemsize <= 2 else np.int64
+    return np.float64
+
+
+def reduce2(tile, dtype=None):
+    # 2x2 local mean that stays in the integer domain; odd edges are zero
+    # padded and results truncated, matching
+    # skimage.transform.downscale_local_mean(tile, (2, 2)).astype(dtype)
+    dtype = tile.dtype if dtype is None else np.dtype(dtype)
+    h, w = tile.shape
+    acc = np.zeros(((h + 1) // 2, (w + 1) // 2), accumulator_dtype(tile.dtype))
+    acc += tile[0::2, 0::2]
+    acc[: h // 2] += tile[1::2, 0::2]
+    acc[:, : w // 2] += tile[0::2, 1::2]
+    acc[: h // 2, : w // 2] += tile[1::2, 1::2]
+    if acc.dtype.kind == "u":
+        acc //= 4
+        return acc.astype(dtype)
+    return (acc / 4).astype(dtype)
 
 
 def preduce(coords, img_in, img_out):
     (iy1, ix1), (iy2, ix2) = coords
     (oy1, ox1), (oy2, ox2) = np.array(coords) // 2
     tile = img_in[iy1:iy2, ix1:ix2]
-    #    tile = skimage.transform.pyramid_reduce(tile, multichannel=False)
-    tile = skimage.transform.downscale_local_mean(tile, (2, 2)).astype(img_out.dtype)
-    #    with warnings.catch_warnings():
-    #        warnings.filterwarnings('ignore', 'Possible precision loss')
-    #        tile = skimage.util.dtype.convert(tile, img_out.dtype)
-    img_out[oy1:oy2, ox1:ox2] = tile
-
-
-def imsave(path, img, tile_size, **kwargs):
-    tifffile.imsave(
-        path,
-        img,
-        bigtiff=True,
-        append=True,
-        tile=(tile_size, tile_size),
+    img_out[oy1:oy2, ox1:ox2] = reduce2(tile, img_out.dtype)
+
+
+def write_image(writer, img, tile_size, **kwargs):
+    writer.write(img, tile=(tile_size, tile_size), metadata=None, **kwargs)
+
+
+def copy_image(writer, page, **kwargs):
+    # write the encoded tiles of a page as they are, without decoding
+    keyframe = page.keyframe
+    fh = page.parent.filehandle
+
+    def segments():
+        for offset, bytecount in zip(page.dataoffsets, page.databytecounts):
+            fh.seek(offset)
+            yield fh.read(bytecount)
+
+    writer.write(
+        segments(),
+        shape=keyframe.shape,
+        dtype=keyframe.dtype,
+        tile=(keyframe.tilelength, keyframe.tilewidth),
+        compression=keyframe.compression,
+        predictor=keyframe.predictor,
         metadata=None,
         **kwargs
     )
@@ -46,8 +84,18 @@ def format_shape(shape):
 
 
 def construct_xml(
-    filename, shapes, num_channels, dtype, pixel_size=1, channel_name_list=None
+    filename,
+    shapes,
+    num_channels,
+    dtype,
+    pixel_size=1,
+    channel_name_list=None,
+    subifds=False,
 ):
+    if subifds:
+        # reduced levels hang off their level-0 IFD and are found by readers
+        # without being listed
+        shapes = shapes[:1]
     if channel_name_list is None:
         channel_name_list = ["Channel {}".format(i) for i in range(num_channels)]
 
@@ -140,12 +188,75 @@ def patch_ometiff_xml(path, xml_bytes):
         f.write(struct.pack("<Q", xml_offset))
 
 
-def build_pyramid(array_list, channel_name_list=None, out_path=None, tile_size=1024):
-    if hasattr(os, "sched_getaffinity"):
-        num_workers = len(os.sched_getaffinity(0))
-    else:
-        num_workers = multiprocessing.cpu_count()
+def level_shapes(base_shape, tile_size):
+    num_levels = max(np.ceil(np.log2(max(base_shape) / tile_size)), 0) + 1
+    factors = 2 ** np.arange(num_levels)
+    return (np.ceil(np.array(base_shape) / factors[:, None])).astype(int)
+
+
+def num_tiles(shape, tile_size):
+    return int(np.prod(-(-np.asarray(shape) // tile_size)))
+
+
+def reduce_levels(img_in, shapes, tile_size, level_paths):
+    # each level is reduced from the one above it in bands of tile rows and
+    # parked in a .npy file until the IFD order lets us write it out;
+    # returns seconds spent per level
+    seconds = []
+    for shape_out, path in zip(shapes[1:], level_paths):
+        start = time.perf_counter()
+        img_out = np.lib.format.open_memmap(
+            path, mode="w+", dtype=img_in.dtype, shape=tuple(map(int, shape_out))
+        )
+        for y in range(0, img_in.shape[0], 2 * tile_size):
+            coords = ((y, 0), (y + 2 * tile_size, 2 * shape_out[1]))
+            preduce(coords, img_in, img_out)
+        img_out.flush()
+        img_in = img_out
+        seconds.append(time.perf_counter() - start)
+    return seconds
 
+
+def reduce_levels_shm(shm_name, shape, dtype, shapes, tile_size, level_paths):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        img_in = np.ndarray(shape, dtype, buffer=shm.buf)
+        seconds = reduce_levels(img_in, shapes, tile_size, level_paths)
+        del img_in
+    finally:
+        shm.close()
+    return seconds
+
+
+def build_pyramid(
+    array_list,
+    channel_name_list=None,
+    out_path=None,
+    tile_size=1024,
+    num_workers=None,
+    memory_limit=2 ** 32,
+    scratch_dir=None,
+    metrics=None,
+    verbose=True,
+    pixel_size=0.325,
+    compression=None,
+    predictor=False,
+    subifds=False,
+):
+    if num_workers is None:
+        if hasattr(os, "sched_getaffinity"):
+            num_workers = len(os.sched_getaffinity(0))
+        else:
+            num_workers = multiprocessing.cpu_count()
+    if metrics is None:
+        metrics = null_metrics
+
+    def log(*args, **kwargs):
+        if verbose:
+            print(*args, **kwargs)
+            sys.stdout.flush()
+
+    array_list = list(array_list) if channel_name_list is None else array_list
     if channel_name_list is None:
         channel_name_list = [str(i + 1) for i in range(len(array_list))]
 
@@ -153,92 +264,329 @@ def build_pyramid(array_list, channel_name_list=None, out_path=None, tile_size=1
         out_path = "./out.ome.tif"
 
     if os.path.exists(out_path):
-        print("%s already exists, aborting" % out_path)
-        sys.exit(1)
-
-    print("Appending input images")
-    for i, img_in in enumerate(array_list):
-        print("    %d: %s" % (i + 1, channel_name_list[i]))
-        if i == 0:
-            base_shape = img_in.shape
-            dtype = img_in.dtype
-            kwargs = {"description": "!!xml!!", "software": "Glencoe/Faas pyramid"}
-        else:
-            if img_in.shape != base_shape:
-                print(
-                    "%s: expected shape %s, got %s"
-                    % (channel_name_list[i], base_shape, img_in.shape)
-                )
-                sys.exit(1)
-            if img_in.dtype != dtype:
-                print(
-                    "%s: expected dtype %s, got %s"
-                    % (channel_name_list[i], dtype, img_in.dtype)
+        raise FileExistsError("%s already exists, aborting" % out_path)
+
+    scratch = tempfile.mkdtemp(prefix="pyramid-", dir=scratch_dir)
+    executor = None
+    if num_workers > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(num_workers)
+    pending = []
+    level_paths = []
+    reduce_busy = 0.0
+
+    def wait_oldest():
+        nonlocal reduce_busy
+        channel, future, shm, level0_kwargs = pending.pop(0)
+        try:
+            seconds = future.result()
+            record_reduce(channel, seconds)
+            reduce_busy += sum(seconds)
+            if level0_kwargs is not None:
+                # SubIFD layout: level 0 is written from the shared copy once
+                # the reduced levels that follow it are ready, while later
+                # channels are still being reduced
+                write(
+                    np.ndarray(base_shape, dtype, buffer=shm.buf),
+                    0,
+                    channel,
+                    **level0_kwargs
                 )
-                sys.exit(1)
-            kwargs = {}
-        imsave(out_path, img_in, tile_size, **kwargs)
-    print()
+                write_reduced(channel)
+        finally:
+            shm.close()
+            shm.unlink()
 
-    num_channels = len(channel_name_list)
-    num_levels = np.ceil(np.log2(max(base_shape) / tile_size)) + 1
-    factors = 2 ** np.arange(num_levels)
-    shapes = (np.ceil(np.array(base_shape) / factors[:, None])).astype(int)
+    def record_reduce(channel, seconds):
+        for level, sec in enumerate(seconds, 1):
+            tiles = num_tiles(shapes[level], tile_size)
+            metrics.record(
+                "reduce",
+                level=level,
+                channel=channel,
+                seconds=sec,
+                tiles=tiles,
+                tiles_per_s=tiles / sec if sec > 0 else None,
+            )
 
-    print("Pyramid level sizes:")
-    for i, shape in enumerate(shapes):
-        print("    level %d: %s" % (i + 1, format_shape(shape)), end="")
-        if i == 0:
-            print(" (original size)", end="")
-        print()
-    print()
+    # one handle for all pages; compressed tiles are encoded by a thread pool
+    writer = tifffile.TiffWriter(out_path, bigtiff=True)
+    fh = writer.filehandle
 
-    executor = concurrent.futures.ThreadPoolExecutor(num_workers)
+    def write(img, level, channel, **kwargs):
+        if subifds and level > 0:
+            kwargs["subfiletype"] = 1
+        with metrics.timer("encode", level=level, channel=channel) as timer:
+            offset = fh.tell()
+            write_image(
+                writer,
+                img,
+                tile_size,
+                compression=compression,
+                predictor=predictor,
+                maxworkers=num_workers,
+                **kwargs
+            )
+            timer.update(
+                bytes_written=fh.tell() - offset,
+                tiles=num_tiles(img.shape, tile_size),
+            )
 
-    shape_pairs = zip(shapes[:-1], shapes[1:])
-    for level, (shape_in, shape_out) in enumerate(shape_pairs):
+    def write_reduced(channel):
+        # SubIFD layout: a channel's reduced levels follow its level 0
+        for level, path in enumerate(level_paths[channel], 1):
+            img_out = np.load(path, mmap_mode="r")
+            write(img_out, level, channel)
+            del img_out
+            os.remove(path)
 
-        print(
-            "Resizing images for level %d (%s -> %s)"
-            % (level + 2, format_shape(shape_in), format_shape(shape_out))
+    start = time.perf_counter()
+    try:
+        log("Appending input images")
+        for i, img_in in enumerate(array_list):
+            log("    %d: %s" % (i + 1, channel_name_list[i]))
+            if i == 0:
+                base_shape = img_in.shape
+                dtype = img_in.dtype
+                shapes = level_shapes(base_shape, tile_size)
+                # each in-flight channel holds a shared copy of its level 0
+                max_pending = min(
+                    num_workers, max(1, memory_limit // max(1, img_in.nbytes))
+                )
+                kwargs = {"description": "!!xml!!", "software": "Glencoe/Faas pyramid"}
+            else:
+                if img_in.shape != base_shape:
+                    raise ValueError(
+                        "%s: expected shape %s, got %s"
+                        % (channel_name_list[i], base_shape, img_in.shape)
+                    )
+                if img_in.dtype != dtype:
+                    raise ValueError(
+                        "%s: expected dtype %s, got %s"
+                        % (channel_name_list[i], dtype, img_in.dtype)
+                    )
+                kwargs = {}
+            if subifds and len(shapes) > 1:
+                kwargs["subifds"] = len(shapes) - 1
+
+            # reduced levels are computed from this in-memory copy of level 0
+            # while it is being written, instead of reading it back later
+            paths = [
+                os.path.join(scratch, "%d-%d.npy" % (i, level))
+                for level in range(1, len(shapes))
+            ]
+            level_paths.append(paths)
+            if executor is None:
+                seconds = reduce_levels(np.asarray(img_in), shapes, tile_size, paths)
+                record_reduce(i, seconds)
+                reduce_busy += sum(seconds)
+            else:
+                while len(pending) >= max_pending:
+                    wait_oldest()
+                shm = shared_memory.SharedMemory(
+                    create=True, size=max(1, img_in.nbytes)
+                )
+                np.ndarray(base_shape, dtype, buffer=shm.buf)[...] = img_in
+                future = executor.submit(
+                    reduce_levels_shm,
+                    shm.name,
+                    base_shape,
+                    dtype,
+                    shapes,
+                    tile_size,
+                    paths,
+                )
+                pending.append((i, future, shm, kwargs if subifds else None))
+            if executor is None or not subifds:
+                write(img_in, 0, i, **kwargs)
+            del img_in
+            if executor is None and subifds:
+                write_reduced(i)
+        log()
+
+        num_channels = len(channel_name_list)
+
+        log("Pyramid level sizes:")
+        for i, shape in enumerate(shapes):
+            log("    level %d: %s" % (i + 1, format_shape(shape)), end="")
+            if i == 0:
+                log(" (original size)", end="")
+            log()
+        log()
+
+        while pending:
+            wait_oldest()
+        metrics.pool(
+            "reduce",
+            num_workers if executor is not None else 1,
+            reduce_busy,
+            time.perf_counter() - start,
         )
 
-        ty = np.array(range(0, shape_in[0], tile_size))
-        tx = np.array(range(0, shape_in[1], tile_size))
-        coords = list(
-            zip(
-                itertools.product(ty, tx),
-                itertools.product(ty + tile_size, tx + tile_size),
+        for level in range(1, 1 if subifds else len(shapes)):
+            log(
+                "Writing images for level %d (%s)"
+                % (level + 1, format_shape(shapes[level]))
             )
-        )
-        img_in = pytiff.Tiff(out_path)
-        img_out = np.empty(shape_out, dtype)
+            for c in range(num_channels):
+                img_out = np.load(level_paths[c][level - 1], mmap_mode="r")
+                write(img_out, level, c)
+                del img_out
+                log("\r    %d/%d" % (c + 1, num_channels), end="")
+            log()
+        log()
+    finally:
+        writer.close()
+        for _, _, shm, _ in pending:
+            shm.close()
+            shm.unlink()
+        if executor is not None:
+            executor.shutdown()
+        shutil.rmtree(scratch, ignore_errors=True)
 
-        for c in range(num_channels):
+    xml = construct_xml(
+        os.path.basename(out_path),
+        shapes,
+        num_channels,
+        dtype,
+        pixel_size,
+        channel_name_list=channel_name_list,
+        subifds=subifds,
+    )
+    patch_ometiff_xml(out_path, xml)
+    metrics.record("done", stage="build_pyramid", seconds=time.perf_counter() - start)
+
+
+def update_pyramid(
+    in_path,
+    channel_list,
+    channel_name_list,
+    out_path,
+    pixel_size=1,
+    filename=None,
+    scratch_dir=None,
+    metrics=None,
+    verbose=True,
+):
+    # channel_list items are either the index of a channel of in_path, whose
+    # encoded tiles are copied level by level, or a new level-0 image (array
+    # or TIFF path) reduced and encoded with the layout of in_path
+    if metrics is None:
+        metrics = null_metrics
 
-            page = level * num_channels + c
-            img_in.set_page(page)
-            for i, _ in enumerate(
-                executor.map(
-                    preduce, coords, itertools.repeat(img_in), itertools.repeat(img_out)
+    def log(*args, **kwargs):
+        if verbose:
+            print(*args, **kwargs)
+            sys.stdout.flush()
+
+    if os.path.exists(out_path):
+        raise FileExistsError("%s already exists, aborting" % out_path)
+
+    tif = tifffile.TiffFile(in_path)
+    scratch = tempfile.mkdtemp(prefix="pyramid-", dir=scratch_dir)
+    writer = None
+    start = time.perf_counter()
+    try:
+        series = tif.series[0]
+        subifds = len(series.levels) > 1
+        if subifds:
+            level_list = [level.pages for level in series.levels]
+        else:
+            level_list = [s.pages for s in tif.series]
+        keyframe = level_list[0][0].keyframe
+        if not keyframe.is_tiled or keyframe.tilelength != keyframe.tilewidth:
+            raise ValueError("%s: expected square tiles" % in_path)
+        tile_size = keyframe.tilelength
+        dtype = keyframe.dtype
+        shapes = np.array([pages[0].keyframe.shape for pages in level_list])
+        if (shapes[1:] != -(-shapes[:-1] // 2)).any():
+            raise ValueError("%s: levels are not halved one by one" % in_path)
+        layout = {"compression": keyframe.compression, "predictor": keyframe.predictor}
+
+        writer = tifffile.TiffWriter(out_path, bigtiff=True)
+        fh = writer.filehandle
+        level_paths = {}
+
+        def write(img, level, channel, **kwargs):
+            if subifds and level > 0:
+                kwargs["subfiletype"] = 1
+            item = channel_list[channel]
+            with metrics.timer("encode", level=level, channel=channel) as timer:
+                offset = fh.tell()
+                if isinstance(item, (int, np.integer)):
+                    page = level_list[level][item]
+                    copy_image(writer, page, **kwargs)
+                    tiles = len(page.dataoffsets)
+                else:
+                    write_image(writer, img, tile_size, **layout, **kwargs)
+                    tiles = num_tiles(img.shape, tile_size)
+                timer.update(bytes_written=fh.tell() - offset, tiles=tiles)
+
+        def write_base(channel, **kwargs):
+            item = channel_list[channel]
+            if isinstance(item, (int, np.integer)):
+                write(None, 0, channel, **kwargs)
+                return
+            img = tifffile.imread(item) if isinstance(item, str) else item
+            if img.shape != tuple(shapes[0]) or img.dtype != dtype:
+                raise ValueError(
+                    "%s: expected %s %s, got %s %s"
+                    % (
+                        channel_name_list[channel],
+                        format_shape(shapes[0]),
+                        dtype,
+                        format_shape(img.shape),
+                        img.dtype,
+                    )
                 )
-            ):
-                percent = int((i + 1) / len(coords) * 100)
-                if i % 20 == 0 or percent == 100:
-                    print("\r    %d: %d%%" % (c + 1, percent), end="")
-                    sys.stdout.flush()
-            imsave(out_path, img_out, tile_size)
-            print()
+            paths = [
+                os.path.join(scratch, "%d-%d.npy" % (channel, level))
+                for level in range(1, len(shapes))
+            ]
+            seconds = reduce_levels(np.asarray(img), shapes, tile_size, paths)
+            for level, sec in enumerate(seconds, 1):
+                metrics.record("reduce", level=level, channel=channel, seconds=sec)
+            level_paths[channel] = paths
+            write(img, 0, channel, **kwargs)
 
-        img_in.close()
-        print()
+        def write_reduced(level, channel):
+            if channel in level_paths:
+                img = np.load(level_paths[channel][level - 1], mmap_mode="r")
+                write(img, level, channel)
+                del img
+            else:
+                write(None, level, channel)
+
+        num_channels = len(channel_list)
+        log("Writing %d channels, %d levels" % (num_channels, len(shapes)))
+        for c in range(num_channels):
+            kwargs = {}
+            if c == 0:
+                kwargs = {"description": "!!xml!!", "software": "Glencoe/Faas pyramid"}
+            if subifds and len(shapes) > 1:
+                kwargs["subifds"] = len(shapes) - 1
+            write_base(c, **kwargs)
+            if subifds:
+                for level in range(1, len(shapes)):
+                    write_reduced(level, c)
+            log("\r    %d/%d" % (c + 1, num_channels), end="")
+        log()
+        for level in range(1, 1 if subifds else len(shapes)):
+            for c in range(num_channels):
+                write_reduced(level, c)
+    finally:
+        if writer is not None:
+            writer.close()
+        tif.close()
+        shutil.rmtree(scratch, ignore_errors=True)
 
     xml = construct_xml(
-        os.path.basename(out_path),
+        filename or os.path.basename(out_path),
         shapes,
         num_channels,
         dtype,
-        0.325,
+        pixel_size,
         channel_name_list=channel_name_list,
+        subifds=subifds,
     )
     patch_ometiff_xml(out_path, xml)
+    metrics.record("done", stage="update_pyramid", seconds=time.perf_counter() - start)
@@ -1,8 +1,109 @@
+import shutil
+import typing
+import concurrent.futures
+
 import numpy as np
-import skimage.measure as smeasure
+
+from .util import default_num_workers, aligned_tile_shape, tile_regions
+from .cache import DiskCache, resolve
+
+
+def hysteresis_label(
+    image: np.ndarray, low: float, high: float
+) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Label connected pixels above the lower bound and flag the labels that
+    reach the higher bound.
+
+    Args:
+        image: np.ndarray
+            Intensity image.
+        low: float
+            Lower bound.
+        high: float
+            Higher bound.
+
+    Return: tuple of (labels, seeded)
+        Label image, and boolean lookup table indexed by label that is True
+        for regions with at least one pixel of intensity higher than high.
+    """
+    import skimage.measure as smeasure
+
+    labels, num = smeasure.label(image > low, background=0, return_num=True)
+    # a region's max reaches high exactly when it contains such a pixel
+    seeded = np.zeros(num + 1, dtype=bool)
+    seeded[labels[image >= high]] = True
+    seeded[0] = False
+    return labels, seeded
+
+
+def stitch(
+    edge_grid: typing.List[typing.List[typing.Tuple[np.ndarray, ...]]],
+    seeded: np.ndarray,
+) -> np.ndarray:
+    """
+    Merge regions of neighbouring tiles that touch across tile borders.
+
+    Args:
+        edge_grid: list of list of tuple of np.ndarray
+            For each tile in row-major grid order, global labels along its
+            top, bottom, left and right edges. Zero is background.
+        seeded: np.ndarray of bool
+            Lookup table of global label to whether the region is seeded.
+
+    Return: np.ndarray of bool
+        Lookup table of global label to whether the merged region it
+        belongs to is seeded.
+    """
+    from scipy import sparse
+    from scipy.sparse import csgraph
+
+    pairs = []
+
+    def touch(a, b):
+        # pixels facing each other across a seam, including diagonals
+        for u, v in [(a, b), (a[:-1], b[1:]), (a[1:], b[:-1])]:
+            pairs.append(np.stack([u, v]))
+
+    num_rows, num_cols = len(edge_grid), len(edge_grid[0])
+    for i in range(num_rows):
+        for j in range(num_cols):
+            _, bottom, _, right = edge_grid[i][j]
+            if j + 1 < num_cols:
+                touch(right, edge_grid[i][j + 1][2])
+            if i + 1 < num_rows:
+                touch(bottom, edge_grid[i + 1][j][0])
+                # corners shared with diagonal neighbours
+                if j + 1 < num_cols:
+                    corner = [bottom[-1], edge_grid[i + 1][j + 1][0][0]]
+                    pairs.append(np.array(corner)[:, None])
+                if j > 0:
+                    corner = [bottom[0], edge_grid[i + 1][j - 1][0][-1]]
+                    pairs.append(np.array(corner)[:, None])
+    pairs = np.concatenate(pairs, axis=1) if pairs else np.zeros((2, 0), dtype=int)
+    pairs = pairs[:, (pairs > 0).all(axis=0)]
+
+    num = seeded.shape[0]
+    graph = sparse.coo_matrix(
+        (np.ones(pairs.shape[1], dtype=np.int8), (pairs[0], pairs[1])), shape=(num, num)
+    )
+    _, component = csgraph.connected_components(graph, directed=False)
+    component_seeded = np.zeros(component.max() + 1, dtype=bool)
+    component_seeded[component[seeded]] = True
+    keep = component_seeded[component]
+    keep[0] = False
+    return keep
 
 
-def pixel2mask(image: np.ndarray, low: float, high: float) -> np.ndarray:
+def pixel2mask(
+    image: np.ndarray,
+    low: float,
+    high: float,
+    tile_size: int = None,
+    out: np.ndarray = None,
+    num_workers: int = None,
+    cache: typing.Union[bool, DiskCache] = True,
+) -> np.ndarray:
     """
     Binarize pixel intensities. Pixels with intensity higher than the lower
     bound and also connected to at least one pixel of intensity higher than
@@ -10,18 +111,141 @@ def pixel2mask(image: np.ndarray, low: float, high: float) -> np.ndarray:
 
     Args:
         image: np.ndarray
-            Intensity image.
+            Intensity image, or anything sliceable like it such as
+            h5py.Dataset, util.TiffArray or a dask array, which is always
+            processed in tiles.
         low: float
             Lower bound.
         high: float
             Higher bound.
+        tile_size: int [optional]
+            If given, label tiles of this size independently and stitch
+            regions across tile borders, so only a few tiles are in memory
+            at a time. Tiles are rounded to whole storage chunks of chunked
+            inputs. Default None, process np.ndarray at once and other
+            inputs in tiles of 1024.
+        out: np.ndarray [optional]
+            Preallocated boolean output of the same shape as image, ex.
+            h5py.Dataset. Default None.
+        num_workers: int [optional]
+            Threads processing tiles. Default None, as many as available
+            CPUs. Ignored without tile_size.
+        cache: bool or cache.DiskCache [optional]
+            Cache to reuse the mask from, stored as packed bits. Default
+            True, the default cache.
 
     Return: np.ndarray of type bool
     """
-    mask = image > low
-    labels = smeasure.label(mask, background=0)
-    for region in smeasure.regionprops(label_image=labels, intensity_image=image):
-        if region.max_intensity < high:
-            mask[region.coords[:, 0], region.coords[:, 1]] = 0
+    if tile_size is None and not isinstance(image, np.ndarray):
+        tile_size = 1024
+    cache = resolve(cache)
+    if cache is not None:
+        key = cache.key("pixel2mask", image, low, high)
+        entry = cache.get(key)
+        if entry is not None:
+            return unpack_mask(entry["bits"], image.shape, tile_size, out)
+    if tile_size is not None:
+        tile_shape = aligned_tile_shape([image], tile_size)
+        if tile_shape[1] % 8 and tile_shape[1] < image.shape[1]:
+            # tiles must start on byte boundaries of the packed rows
+            cache = None
+
+    if tile_size is None:
+        labels, seeded = hysteresis_label(np.asarray(image), low, high)
+        mask = seeded[labels]
+        if cache is not None:
+            cache.put(key, bits=np.packbits(mask, axis=1))
+        if out is None:
+            return mask
+        out[...] = mask
+        return out
+
+    if out is None:
+        out = np.zeros(image.shape, dtype=bool)
+    if num_workers is None:
+        num_workers = default_num_workers()
+    region_list = tile_regions(image.shape, tile_shape)
+    num_rows = -(-image.shape[0] // tile_shape[0])
+    num_cols = -(-image.shape[1] // tile_shape[1])
+
+    def label_tile(region):
+        labels, seeded = hysteresis_label(np.asarray(image[region]), low, high)
+        edges = (labels[0], labels[-1], labels[:, 0], labels[:, -1])
+        return seeded, edges
+
+    with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+        # first pass: label each tile, keep only seeds and border labels
+        result_list = list(executor.map(label_tile, region_list))
+        offset = np.cumsum([0] + [seeded.shape[0] - 1 for seeded, _ in result_list])
+        seeded = np.concatenate([[False]] + [seeded[1:] for seeded, _ in result_list])
+        edge_grid = [[None] * num_cols for _ in range(num_rows)]
+        for k, (_, edges) in enumerate(result_list):
+            edge_grid[k // num_cols][k % num_cols] = tuple(
+                np.where(e > 0, e + offset[k], 0) for e in edges
+            )
+        keep = stitch(edge_grid, seeded)
 
-    return mask
+        # second pass: label each tile again and paint kept regions
+        def paint_tile(args):
+            region, start = args
+            labels, _ = hysteresis_label(np.asarray(image[region]), low, high)
+            return region, keep[np.where(labels > 0, labels + start, 0)]
+
+        if cache is not None:
+            # packed rows go to a memory-mapped file of the new cache entry
+            # as tiles complete, so caching keeps the tiled memory bound
+            tmp = cache.begin(key)
+            bits = np.lib.format.open_memmap(
+                tmp / "bits.npy",
+                mode="w+",
+                dtype=np.uint8,
+                shape=(image.shape[0], -(-image.shape[1] // 8)),
+            )
+        try:
+            for region, mask in executor.map(paint_tile, zip(region_list, offset)):
+                out[region] = mask
+                if cache is not None:
+                    packed = np.packbits(mask, axis=1)
+                    start = region[1].start // 8
+                    bits[region[0], start : start + packed.shape[1]] = packed
+        except BaseException:
+            if cache is not None:
+                del bits
+                shutil.rmtree(tmp, ignore_errors=True)
+            raise
+    if cache is not None:
+        bits.flush()
+        del bits
+        cache.commit(key, tmp)
+
+    return out
+
+
+def unpack_mask(
+    bits: np.ndarray,
+    shape: typing.Tuple[int, int],
+    block_rows: int = None,
+    out: np.ndarray = None,
+) -> np.ndarray:
+    """
+    Unpack a boolean mask packed along rows with np.packbits.
+
+    Args:
+        bits: np.ndarray of type uint8
+            Packed rows.
+        shape: tuple of int
+            Shape of the mask.
+        block_rows: int [optional]
+            Rows unpacked at a time into out. Default None, all at once.
+        out: np.ndarray [optional]
+            Preallocated boolean output, ex. h5py.Dataset. Default None.
+
+    Return: np.ndarray of type bool
+    """
+    if out is None:
+        out = np.empty(shape, dtype=bool)
+    block_rows = block_rows or max(1, shape[0])
+    for y in range(0, shape[0], block_rows):
+        rows = slice(y, y + block_rows)
+        out[rows] = np.unpackbits(bits[rows], axis=1, count=shape[1]).view(bool)
+    return out
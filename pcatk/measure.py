@@ -1,11 +1,75 @@
 import typing
+import concurrent.futures
 
 import numpy as np
-import pandas as pd
 
-from skimage.measure import regionprops
+from .util import default_num_workers, aligned_tile_shape, tile_regions
+from .cache import DiskCache, resolve
 
-from external import blockwise_view
+
+def summed_area_table(arr: np.ndarray) -> np.ndarray:
+    """
+    Integral image with a leading row and column of zeros.
+
+    Args:
+        arr: np.ndarray
+            Input 2-D image.
+
+    Return: np.ndarray of shape (N + 1, M + 1) where element (i, j) is the
+        sum of arr[:i, :j].
+    """
+    out = np.zeros((arr.shape[0] + 1, arr.shape[1] + 1), dtype=np.float64)
+    np.cumsum(arr, axis=0, dtype=np.float64, out=out[1:, 1:])
+    np.cumsum(out[1:, 1:], axis=1, out=out[1:, 1:])
+    return out
+
+
+def window_corrcoef(
+    arr1: np.ndarray,
+    arr2: np.ndarray,
+    top: np.ndarray,
+    left: np.ndarray,
+    block_shape: typing.Tuple[int, int],
+) -> np.ndarray:
+    """
+    Correlation coefficient of every window on a grid, from integral images.
+
+    Args:
+        arr1, arr2: np.ndarray
+            Input images to compare, in memory.
+        top, left: np.ndarray
+            Window origins along each axis. Windows reaching past the image
+            are truncated to it.
+        block_shape: tuple of int
+            Shape of the windows.
+
+    Return: np.ndarray of shape (len(top), len(left))
+    """
+    x = np.asarray(arr1, dtype=np.float64)
+    y = np.asarray(arr2, dtype=np.float64)
+    # correlation is shift invariant, centering keeps the tables small
+    x = x - x.mean()
+    y = y - y.mean()
+    bottom = np.minimum(top + block_shape[0], x.shape[0])
+    right = np.minimum(left + block_shape[1], x.shape[1])
+
+    def window_sum(v):
+        sat = summed_area_table(v)
+        return (
+            sat[np.ix_(bottom, right)]
+            - sat[np.ix_(top, right)]
+            - sat[np.ix_(bottom, left)]
+            + sat[np.ix_(top, left)]
+        )
+
+    count = np.outer(bottom - top, right - left)
+    sum_x, sum_y = window_sum(x), window_sum(y)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cov = window_sum(x * y) - sum_x * sum_y / count
+        var_x = window_sum(x * x) - sum_x ** 2 / count
+        var_y = window_sum(y * y) - sum_y ** 2 / count
+        out = np.clip(cov / np.sqrt(var_x * var_y), -1, 1)
+    return out
 
 
 def minitile_corrcoef(
@@ -13,71 +77,526 @@ def minitile_corrcoef(
     arr2: np.ndarray,
     block_shape: typing.Tuple[int, int],
     keep_shape: bool = False,
+    step: typing.Tuple[int, int] = None,
+    pad: bool = False,
+    tile_size: int = 1024,
+    num_workers: int = None,
+    out: np.ndarray = None,
 ) -> np.ndarray:
     """
     Blockwise correlation coefficient.
 
     Args:
         arr1, arr2: np.ndarray
-            Input images to compare.
+            Input images to compare. Anything sliceable like np.ndarray,
+            including h5py.Dataset, np.memmap, util.TiffArray and dask
+            arrays, read one tile at a time.
         block_shape: tuple of int
             Shape of mini-tile.
         keep_shape: bool [optional]
             Keep same shape as input images or just one pixel per mini-tile.
             Default False.
+        step: tuple of int [optional]
+            Distance between mini-tiles. Default None, same as block_shape
+            for non-overlapping mini-tiles; (1, 1) gives a sliding window.
+        pad: bool [optional]
+            If True, mini-tiles running past the bottom and right edges are
+            kept and computed over their in-bounds pixels, else dropped.
+            Default False.
+        tile_size: int [optional]
+            Approximate edge length of input read per work unit, rounded to
+            whole storage chunks of chunked inputs. Default 1024.
+        num_workers: int [optional]
+            Threads computing tiles. Default None, as many as available CPUs.
+        out: np.ndarray [optional]
+            Preallocated output, ex. h5py.Dataset for maps too large to hold
+            in memory. Not supported with keep_shape. Default None.
 
     Return: correlation coefficient heatmap.
     """
-    # make blocks
-    b1 = blockwise_view(arr1, block_shape, require_aligned_blocks=False, aslist=False)
-    b2 = blockwise_view(arr2, block_shape, require_aligned_blocks=False, aslist=False)
-    # subtract mean
-    axes = tuple(np.arange(b1.ndim, dtype=int)[b1.ndim // 2:])
-    b1 -= b1.mean(axis=axes, keepdims=True)
-    b2 -= b2.mean(axis=axes, keepdims=True)
-    # numerator of corrcoef
-    numerator = np.multiply(b1, b2).mean(axis=axes, keepdims=keep_shape)
-    # denomenator of corrcoef
-    dof = np.prod(b1.shape[slice(axes[0], axes[-1] + 1)])
-    b1_std = np.sqrt((b1 ** 2).mean(axis=axes, keepdims=keep_shape) / dof)
-    b2_std = np.sqrt((b2 ** 2).mean(axis=axes, keepdims=keep_shape) / dof)
-    denominator = np.multiply(b1_std, b2_std)
-    # divide
-    out = np.divide(numerator, denominator)
+    shape = arr1.shape
+    block_shape = tuple(block_shape)
+    step = block_shape if step is None else tuple(step)
+    if keep_shape and out is not None:
+        raise ValueError("keep_shape is not supported with out")
+
+    # number of mini-tiles and work units along each axis
+    if pad:
+        out_shape = tuple(
+            -(-max(s - b, 0) // d) + 1 for s, b, d in zip(shape, block_shape, step)
+        )
+    else:
+        out_shape = tuple(
+            max(0, (s - b) // d + 1) for s, b, d in zip(shape, block_shape, step)
+        )
+    # work units start on chunk boundaries when the step divides the tile
+    tile_shape = aligned_tile_shape([arr1, arr2], tile_size)
+    unit = tuple(
+        max(1, t // d) if t % d == 0 else max(1, (t - b) // d + 1)
+        for t, b, d in zip(tile_shape, block_shape, step)
+    )
+    if out is None:
+        out = np.empty(out_shape, dtype=np.float64)
+    elif tuple(out.shape) != out_shape:
+        raise ValueError(f"out has shape {out.shape}, expected {out_shape}")
+
+    def run(origin):
+        # window indices of this work unit and the input region they span
+        rows, cols = [
+            np.arange(o, min(o + u, n)) for o, u, n in zip(origin, unit, out_shape)
+        ]
+        top, left = rows * step[0], cols * step[1]
+        bottom = min(top[-1] + block_shape[0], shape[0])
+        right = min(left[-1] + block_shape[1], shape[1])
+        region = (slice(top[0], bottom), slice(left[0], right))
+        coef = window_corrcoef(
+            arr1[region], arr2[region], top - top[0], left - left[0], block_shape
+        )
+        return (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1)), coef
+
+    origin_list = [
+        (i, j)
+        for i in range(0, out_shape[0], unit[0])
+        for j in range(0, out_shape[1], unit[1])
+    ]
+    if num_workers is None:
+        num_workers = default_num_workers()
+    with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+        for region, coef in executor.map(run, origin_list):
+            out[region] = coef
+
+    if keep_shape:
+        # every pixel takes the value of the mini-tile it falls in
+        full = np.full(shape, np.nan, dtype=np.float64)
+        expanded = np.repeat(np.repeat(out, step[0], axis=0), step[1], axis=1)
+        expanded = expanded[: shape[0], : shape[1]]
+        full[: expanded.shape[0], : expanded.shape[1]] = expanded
+        out = full
 
     return out
 
 
+def label_moments(
+    arr1: np.ndarray, arr2: np.ndarray, mask: np.ndarray, block_rows: int = 1024
+) -> np.ndarray:
+    """
+    Per-label sums needed for Pearson correlation, in one pass over pixels.
+
+    Args:
+        arr1, arr2: np.ndarray
+            Input images to compare.
+        mask: np.ndarray
+            Mask of non-negative integer defining regions.
+        block_rows: int [optional]
+            Rows processed at a time to bound temporaries. Default 1024.
+
+    Return: np.ndarray of shape (6, max label + 1)
+        Rows are pixel count, sum of x, y, x^2, y^2 and xy of each label.
+    """
+    num_labels = int(np.max(mask)) + 1
+    moments = np.zeros((6, num_labels), dtype=np.float64)
+    for start in range(0, mask.shape[0], block_rows):
+        rows = slice(start, start + block_rows)
+        label = np.asarray(mask[rows]).ravel().astype(np.intp, copy=False)
+        x = np.asarray(arr1[rows], dtype=np.float64).ravel()
+        y = np.asarray(arr2[rows], dtype=np.float64).ravel()
+        for i, weights in enumerate([None, x, y, x * x, y * y, x * y]):
+            moments[i] += np.bincount(label, weights=weights, minlength=num_labels)
+
+    return moments
+
+
+def label_pixels(
+    mask: np.ndarray, cache: typing.Union[bool, DiskCache] = True
+) -> typing.Dict[str, np.ndarray]:
+    """
+    Pixels of every label in compressed sparse row form, i.e. the flat
+    indices of the pixels of label[i] are pixel[offset[i] : offset[i + 1]].
+
+    Args:
+        mask: np.ndarray
+            Mask of non-negative integer defining regions, 0 being
+            background.
+        cache: bool or cache.DiskCache [optional]
+            Cache to reuse the result from. Default True, the default cache.
+
+    Return: dict of str -> np.ndarray
+        Keys label, offset and pixel.
+    """
+    cache = resolve(cache)
+    if cache is not None:
+        key = cache.key("label_pixels", mask)
+        csr = cache.get(key)
+        if csr is not None:
+            return csr
+
+    flat = np.asarray(mask).ravel()
+    pixel = np.flatnonzero(flat)
+    label = flat[pixel]
+    order = np.argsort(label, kind="stable")
+    pixel, label = pixel[order], label[order]
+    start = np.flatnonzero(np.diff(label, prepend=label[:1] - 1))
+    index_dtype = np.uint32 if flat.size < 2 ** 32 else np.int64
+    csr = {
+        "label": label[start],
+        "offset": np.r_[start, label.size].astype(np.int64),
+        "pixel": pixel.astype(index_dtype),
+    }
+    if cache is not None:
+        cache.put(key, **csr)
+    return csr
+
+
+def pixel_moments(
+    arr1: np.ndarray,
+    arr2: np.ndarray,
+    csr: typing.Dict[str, np.ndarray],
+    block_pixels: int = 2 ** 22,
+) -> np.ndarray:
+    """
+    Same as label_moments, from the pixel lists of label_pixels.
+
+    Args:
+        arr1, arr2: np.ndarray
+            Input images to compare, in memory or memory-mapped.
+        csr: dict of str -> np.ndarray
+            Output of label_pixels for the mask.
+        block_pixels: int [optional]
+            Pixels gathered at a time to bound temporaries. Default 2 ** 22.
+
+    Return: np.ndarray of shape (6, max label + 1)
+    """
+    label, offset, pixel = csr["label"], csr["offset"], csr["pixel"]
+    num_labels = int(label[-1]) + 1 if label.size else 1
+    moments = np.zeros((6, num_labels), dtype=np.float64)
+    moments[0, label] = np.diff(offset)
+    flat1, flat2 = arr1.reshape(-1), arr2.reshape(-1)
+    # blocks end on label boundaries so each reduceat segment is whole
+    i = 0
+    while i < label.size:
+        j = max(i + 1, np.searchsorted(offset, offset[i] + block_pixels, "right") - 1)
+        index = pixel[offset[i] : offset[j]]
+        x = flat1[index].astype(np.float64)
+        y = flat2[index].astype(np.float64)
+        start = offset[i:j] - offset[i]
+        for k, v in enumerate([x, y, x * x, y * y, x * y], 1):
+            moments[k, label[i:j]] = np.add.reduceat(v, start)
+        i = j
+
+    return moments
+
+
 def region_corrcoef(
-    arr1: np.ndarray, arr2: np.ndarray, mask: np.ndarray, return_dataframe: bool = True
-) -> typing.Union[np.ndarray, pd.DataFrame]:
+    arr1: np.ndarray,
+    arr2: np.ndarray,
+    mask: np.ndarray,
+    return_dataframe: bool = True,
+    cache: typing.Union[bool, DiskCache] = True,
+    tile_size: int = 1024,
+    num_workers: int = None,
+    out: np.ndarray = None,
+) -> typing.Union[np.ndarray, "pd.DataFrame"]:
     """
     Region-wise correlation coefficient.
 
     Args:
         arr1, arr2: np.ndarray
-            Input images to compare.
+            Input images to compare. Anything sliceable like np.ndarray,
+            including h5py.Dataset, util.TiffArray and dask arrays, is read
+            one tile at a time.
         mask: np.ndarray
-            Mask of integer defining regions.
+            Mask of integer defining regions, sliceable like the images.
+            Regions spanning several tiles are merged by label.
         return_dataframe: bool [optional]
             If True, return dataframe of region label and correlation
             coefficients, else return an array with same shape as input.
             Default True.
+        cache: bool or cache.DiskCache [optional]
+            Cache of the pixel lists of the mask, see label_pixels, used
+            when all inputs are np.ndarray. Default True, the default
+            cache.
+        tile_size: int [optional]
+            Edge length of tiles read from inputs other than np.ndarray,
+            rounded to whole storage chunks. Default 1024.
+        num_workers: int [optional]
+            Threads processing tiles. Default None, as many as available
+            CPUs.
+        out: np.ndarray [optional]
+            Preallocated output image without return_dataframe, ex.
+            h5py.Dataset, painted one tile at a time. Default None.
     """
-    # if memory usage is an issue here, pass dask.array as input
-    # and use dask_image.ndmeasure.labeled_comprehension
-    coef_dict = {}
-    for region in regionprops(mask):
-        pix1 = arr1[region.coords[:, 0], region.coords[:, 1]]
-        pix2 = arr2[region.coords[:, 0], region.coords[:, 1]]
-        coef_dict[region.label] = np.corrcoef(pix1, pix2)[0, 1]
+    import pandas as pd
+
+    # grouped sums by label replace a regionprops loop over every region
+    cache = resolve(cache)
+    lazy = not all(isinstance(a, np.ndarray) for a in (arr1, arr2, mask))
+    if num_workers is None:
+        num_workers = default_num_workers()
+    region_list = tile_regions(
+        mask.shape, aligned_tile_shape([mask, arr1, arr2], tile_size)
+    )
+    if lazy:
+        with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+            sums, _ = merge_features(
+                executor.map(
+                    lambda region: tile_features([arr1, arr2], mask, region, True),
+                    region_list,
+                ),
+                num_channels=2,
+                correlation=True,
+            )
+        # count, then sums of x, y, x^2, y^2 and xy, see tile_features
+        moments = sums[:, [0, 3, 4, 5, 6, 7]].T
+    elif cache is not None:
+        moments = pixel_moments(arr1, arr2, label_pixels(mask, cache))
+    else:
+        moments = label_moments(arr1, arr2, mask)
+    count, sum_x, sum_y, sum_xx, sum_yy, sum_xy = moments
+    label = np.flatnonzero(count)
+    label = label[label > 0]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cov = sum_xy - sum_x * sum_y / count
+        var_x = sum_xx - sum_x ** 2 / count
+        var_y = sum_yy - sum_y ** 2 / count
+        coef = np.clip(cov / np.sqrt(var_x * var_y), -1, 1)
 
     if return_dataframe:
-        df = pd.DataFrame.from_records(
-            list(coef_dict.items()), columns=["label", "corrcoef"]
-        )
+        df = pd.DataFrame({"label": label, "corrcoef": coef[label]})
         return df
     else:
-        coef_dict[0] = 0.0
-        coef_image = np.vectorize(lambda x: coef_dict[x])(mask)
-        return coef_image
+        # lookup table indexed by label paints the output image
+        lut = np.zeros(count.shape[0], dtype=np.float64)
+        lut[label] = coef[label]
+        if out is None and not lazy:
+            return lut[mask]
+        if out is None:
+            out = np.zeros(mask.shape, dtype=np.float64)
+
+        def paint(region):
+            out[region] = lut[np.asarray(mask[region])]
+
+        with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+            for _ in executor.map(paint, region_list):
+                pass
+        return out
+
+
+def tile_features(
+    image_list: typing.List[np.ndarray],
+    mask: np.ndarray,
+    region: typing.Tuple[slice, slice],
+    correlation: bool = False,
+) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Per-label sums and maxima of a multi-channel tile, see region_features.
+
+    Args:
+        image_list: list of np.ndarray
+            Channel images, sliceable like np.ndarray.
+        mask: np.ndarray
+            Mask of non-negative integer defining regions.
+        region: tuple of slice
+            Rows and columns of the tile, starting from zero.
+        correlation: bool [optional]
+            Also sum cross products of every channel pair. Default False.
+
+    Return: tuple of (label, sums, maxima)
+        Labels present in the tile, and for each of them one row of pixel
+        count, sum of row and column, then per channel sum and sum of
+        squares, then cross products of channel pairs (i, j > i), and one
+        row of per channel maxima.
+    """
+    label = np.asarray(mask[region])
+    rows, cols = np.nonzero(label)
+    label = label[rows, cols]
+    num_channels = len(image_list)
+    num_pairs = num_channels * (num_channels - 1) // 2 if correlation else 0
+    if label.size == 0:
+        return (
+            np.zeros(0, dtype=np.intp),
+            np.zeros((0, 3 + 2 * num_channels + num_pairs)),
+            np.zeros((0, num_channels)),
+        )
+    # sorting pixels by label turns grouped reductions into reduceat
+    order = np.argsort(label, kind="stable")
+    label, rows, cols = label[order], rows[order], cols[order]
+    starts = np.flatnonzero(np.r_[True, label[1:] != label[:-1]])
+    x = np.empty((label.size, num_channels), dtype=np.float64)
+    for c, image in enumerate(image_list):
+        x[:, c] = np.asarray(image[region])[rows, cols]
+
+    column_list = [
+        np.diff(np.r_[starts, label.size])[:, None],
+        np.add.reduceat((rows + region[0].start)[:, None], starts).astype(np.float64),
+        np.add.reduceat((cols + region[1].start)[:, None], starts).astype(np.float64),
+        np.add.reduceat(x, starts),
+        np.add.reduceat(x * x, starts),
+    ]
+    for c in range(num_channels - 1 if correlation else 0):
+        column_list.append(np.add.reduceat(x[:, c : c + 1] * x[:, c + 1 :], starts))
+    sums = np.concatenate(column_list, axis=1)
+    maxima = np.maximum.reduceat(x, starts)
+    return label[starts].astype(np.intp), sums, maxima
+
+
+def merge_features(
+    result_iter: typing.Iterable[typing.Tuple[np.ndarray, np.ndarray, np.ndarray]],
+    num_channels: int,
+    correlation: bool = False,
+) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Merge per-tile outputs of tile_features into tables indexed by label,
+    as they come, so regions spanning several tiles are summed up whole.
+
+    Args:
+        result_iter: iterable of tuple of np.ndarray
+            Outputs of tile_features.
+        num_channels: int
+            Number of channels given to tile_features.
+        correlation: bool [optional]
+            Same as given to tile_features. Default False.
+
+    Return: tuple of (sums, maxima)
+        Rows indexed by label up to the largest one, columns as in
+        tile_features. Labels never seen have a count of zero.
+    """
+    num_pairs = num_channels * (num_channels - 1) // 2 if correlation else 0
+    sums = np.zeros((1, 3 + 2 * num_channels + num_pairs), dtype=np.float64)
+    maxima = np.full((1, num_channels), -np.inf)
+    for label, tile_sums, tile_maxima in result_iter:
+        if label.size == 0:
+            continue
+        if label[-1] >= sums.shape[0]:
+            grow = label[-1] + 1 - sums.shape[0]
+            sums = np.pad(sums, ((0, grow), (0, 0)))
+            maxima = np.pad(maxima, ((0, grow), (0, 0)), constant_values=-np.inf)
+        sums[label] += tile_sums
+        maxima[label] = np.maximum(maxima[label], tile_maxima)
+    return sums, maxima
+
+
+_feature_inputs = None
+
+
+def _init_features(image_list, mask, correlation):
+    global _feature_inputs
+    _feature_inputs = (image_list, mask, correlation)
+
+
+def _tile_features(region):
+    image_list, mask, correlation = _feature_inputs
+    return tile_features(image_list, mask, region, correlation)
+
+
+def region_features(
+    image_dict: typing.Dict[str, np.ndarray],
+    mask: np.ndarray,
+    correlation: bool = False,
+    tile_size: int = 1024,
+    num_workers: int = None,
+    processes: bool = False,
+    out_filepath: str = None,
+) -> "pd.DataFrame":
+    """
+    Per-cell features of many channels in one pass over the mask and
+    images, tile by tile: area, centroid, and per channel mean, sum, max
+    and standard deviation, optionally with the correlation coefficient of
+    every channel pair.
+
+    Args:
+        image_dict: dict of str -> np.ndarray
+            Channel name -> image. Anything sliceable like np.ndarray,
+            including h5py.Dataset, util.TiffArray and util.ChannelArray.
+        mask: np.ndarray
+            Mask of non-negative integer defining regions, 0 being
+            background. Sliceable like the images.
+        correlation: bool [optional]
+            Add corrcoef columns of every channel pair, as region_corrcoef
+            would give. Default False.
+        tile_size: int [optional]
+            Edge length of the tiles read at a time, rounded to whole
+            storage chunks of chunked inputs. Default 1024.
+        num_workers: int [optional]
+            Workers processing tiles. Default None, as many as available
+            CPUs.
+        processes: bool [optional]
+            Split tiles across processes instead of threads. Inputs are
+            passed to each worker once, so they should be file-backed, ex.
+            util.TiffArray, or shared through fork. Default False.
+        out_filepath: str [optional]
+            Also save the table, as Parquet if the suffix is .parquet,
+            else as CSV. Default None.
+
+    Return: pd.DataFrame
+        One row per label with columns label, area, centroid-0, centroid-1,
+        then {channel}_mean, {channel}_sum, {channel}_max, {channel}_std,
+        and with correlation corrcoef_{channel1}_{channel2}.
+    """
+    import pandas as pd
+
+    name_list = list(image_dict)
+    image_list = [image_dict[name] for name in name_list]
+    num_channels = len(name_list)
+    if num_workers is None:
+        num_workers = default_num_workers()
+    region_list = tile_regions(
+        mask.shape, aligned_tile_shape([mask] + image_list, tile_size)
+    )
+
+    if processes:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            num_workers,
+            initializer=_init_features,
+            initargs=(image_list, mask, correlation),
+        )
+        run = _tile_features
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(num_workers)
+
+        def run(region):
+            return tile_features(image_list, mask, region, correlation)
+
+    with executor:
+        sums, maxima = merge_features(
+            executor.map(run, region_list), num_channels, correlation
+        )
+
+    label = np.flatnonzero(sums[:, 0])
+    sums, maxima = sums[label], maxima[label]
+    count = sums[:, :1]
+    channel_sum = sums[:, 3 : 3 + num_channels]
+    mean = channel_sum / count
+    sum_sq = sums[:, 3 + num_channels : 3 + 2 * num_channels]
+    var = np.maximum(sum_sq / count - mean ** 2, 0)
+    column_dict = {
+        "label": label,
+        "area": count[:, 0].astype(np.int64),
+        "centroid-0": sums[:, 1] / count[:, 0],
+        "centroid-1": sums[:, 2] / count[:, 0],
+    }
+    for c, name in enumerate(name_list):
+        column_dict[f"{name}_mean"] = mean[:, c]
+        column_dict[f"{name}_sum"] = channel_sum[:, c]
+        column_dict[f"{name}_max"] = maxima[:, c]
+        column_dict[f"{name}_std"] = np.sqrt(var[:, c])
+    if correlation:
+        # same formula as region_corrcoef, pairs in the order of tile_features
+        n = count[:, 0]
+        k = 3 + 2 * num_channels
+        for i in range(num_channels):
+            for j in range(i + 1, num_channels):
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    cov = sums[:, k] - channel_sum[:, i] * channel_sum[:, j] / n
+                    var_x = sum_sq[:, i] - channel_sum[:, i] ** 2 / n
+                    var_y = sum_sq[:, j] - channel_sum[:, j] ** 2 / n
+                    coef = np.clip(cov / np.sqrt(var_x * var_y), -1, 1)
+                column_dict[f"corrcoef_{name_list[i]}_{name_list[j]}"] = coef
+                k += 1
+    df = pd.DataFrame(column_dict)
+
+    if out_filepath is not None:
+        if str(out_filepath).endswith(".parquet"):
+            df.to_parquet(out_filepath, index=False)
+        else:
+            df.to_csv(out_filepath, index=False)
+    return df
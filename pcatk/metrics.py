@@ -0,0 +1,189 @@
+import io
+import json
+import time
+import typing
+import threading
+from pathlib import Path
+
+import numpy as np
+
+
+class Timer:
+    """
+    Context manager timing one stage and recording it on exit with the
+    fields given so far. Fields known only at the end, like bytes written,
+    can be added with update.
+    """
+
+    __slots__ = ("metrics", "event", "fields", "start", "seconds")
+
+    def __init__(self, metrics: "Metrics", event: str, **fields):
+        self.metrics = metrics
+        self.event = event
+        self.fields = fields
+        self.seconds = None
+
+    def update(self, **fields):
+        self.fields.update(fields)
+
+    def __enter__(self) -> "Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self.start
+        if "tiles" in self.fields and self.seconds > 0:
+            self.fields["tiles_per_s"] = self.fields["tiles"] / self.seconds
+        self.metrics.record(self.event, seconds=self.seconds, **self.fields)
+
+
+class NullTimer:
+    """
+    Timer of the default sink, does nothing.
+    """
+
+    __slots__ = ()
+    seconds = None
+
+    def update(self, **fields):
+        pass
+
+    def __enter__(self) -> "NullTimer":
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_null_timer = NullTimer()
+
+
+class Metrics:
+    """
+    Instrumentation sink receiving structured records from the pyramid and
+    conversion pipelines: per-stage timings, bytes read and written, tile
+    throughput per level and channel, and worker pool utilization.
+
+    This base class drops every record and is the default, so pipelines pay
+    nothing unless a sink is passed. Subclass and override record, or use
+    CallbackMetrics or JsonLinesMetrics.
+    """
+
+    enabled = False
+
+    def record(self, event: str, **fields):
+        """
+        Receive one record.
+
+        Args:
+            event: str
+                Record type, ex. "decode", "reduce", "encode", "pool".
+            fields:
+                Record content, ex. level, channel, seconds, bytes_read.
+        """
+
+    def timer(self, event: str, **fields) -> typing.Union[Timer, NullTimer]:
+        """
+        Time a stage, recording event with its seconds and fields on exit.
+        """
+        if not self.enabled:
+            return _null_timer
+        return Timer(self, event, **fields)
+
+    def pool(
+        self, stage: str, num_workers: int, busy_seconds: float, wall_seconds: float
+    ):
+        """
+        Record how busy a worker pool was over a stage.
+
+        Args:
+            stage: str
+                Stage the pool ran.
+            num_workers: int
+                Pool size.
+            busy_seconds: float
+                Seconds the workers spent on tasks, summed over workers.
+            wall_seconds: float
+                Elapsed seconds of the stage.
+        """
+        if not self.enabled:
+            return
+        capacity = num_workers * wall_seconds
+        self.record(
+            "pool",
+            stage=stage,
+            num_workers=num_workers,
+            busy_seconds=busy_seconds,
+            wall_seconds=wall_seconds,
+            utilization=busy_seconds / capacity if capacity > 0 else None,
+        )
+
+
+null_metrics = Metrics()
+
+
+class CallbackMetrics(Metrics):
+    """
+    Pass every record as a dict to a callback.
+
+    Args:
+        callback: callable
+            Called with dict of "time", "event" and the record fields, from
+            whichever thread produced the record.
+    """
+
+    enabled = True
+
+    def __init__(self, callback: typing.Callable[[dict], typing.Any]):
+        self.callback = callback
+
+    def record(self, event: str, **fields):
+        self.callback({"time": time.time(), "event": event, **fields})
+
+
+def _to_json(obj):
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return float(obj)
+    if isinstance(obj, (np.ndarray, tuple)):
+        return list(obj)
+    return str(obj)
+
+
+class JsonLinesMetrics(Metrics):
+    """
+    Write every record as one JSON line.
+
+    Args:
+        file: str or file-like object
+            Path to append to, or an open text stream like sys.stderr.
+    """
+
+    enabled = True
+
+    def __init__(self, file: typing.Union[str, Path, io.TextIOBase]):
+        if isinstance(file, (str, Path)):
+            self.file = open(file, "a")
+            self.owned = True
+        else:
+            self.file = file
+            self.owned = False
+        self.lock = threading.Lock()
+
+    def record(self, event: str, **fields):
+        record = {"time": time.time(), "event": event, **fields}
+        line = json.dumps(record, default=_to_json)
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def close(self):
+        if self.owned:
+            self.file.close()
+
+    def __enter__(self) -> "JsonLinesMetrics":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,4 +1,11 @@
+import os
+import shutil
+import typing
+import collections
 from pathlib import Path
+from threading import Lock
+
+import numpy as np
 
 
 def check_overwrite(overwrite: bool, path: Path):
@@ -15,6 +22,416 @@ def check_overwrite(overwrite: bool, path: Path):
         if path.is_file():
             path.unlink()
         elif path.is_dir():
-            path.rmdir()
+            shutil.rmtree(path)
     elif path.exists():
         raise ValueError(f"{path} exists but overwrite is set to {overwrite}")
+
+
+def default_num_workers() -> int:
+    """
+    Number of CPUs available to this process.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+def chunk_shape(array: typing.Any) -> typing.Optional[typing.Tuple[int, int]]:
+    """
+    Storage chunk shape of the last two axes of a lazy array, ex. the tile
+    shape of a util.TiffArray, the chunks of h5py.Dataset or zarr.Array,
+    or the chunk size of a dask array.
+
+    Args:
+        array: array-like
+            Array to inspect.
+
+    Return: tuple of int, or None for arrays in memory or not chunked.
+    """
+    # dask arrays list every chunk in .chunks and the largest in .chunksize
+    chunks = getattr(array, "chunksize", None) or getattr(array, "chunks", None)
+    if not chunks or not all(isinstance(c, (int, np.integer)) for c in chunks):
+        return None
+    return tuple(int(c) for c in chunks[-2:])
+
+
+def aligned_tile_shape(
+    array_list: typing.List[typing.Any], tile_size: int
+) -> typing.Tuple[int, int]:
+    """
+    Tile shape close to tile_size made of whole storage chunks, so tiles
+    read from chunked arrays never share a chunk. Chunks of all arrays are
+    matched when their sizes fit together, else the largest is used.
+
+    Args:
+        array_list: list of array-like
+            Arrays read tile by tile, see chunk_shape.
+        tile_size: int
+            Preferred tile edge length.
+
+    Return: tuple of int
+    """
+    chunk_list = [chunk_shape(array) for array in array_list]
+    chunk_list = [c for c in chunk_list if c is not None]
+    tile_shape = []
+    for axis in range(2):
+        sizes = [c[axis] for c in chunk_list]
+        step = int(np.lcm.reduce(sizes)) if sizes else 1
+        if sizes and step > 4 * max(tile_size, *sizes):
+            step = max(sizes)
+        tile_shape.append(max(1, round(tile_size / step)) * step)
+    return tuple(tile_shape)
+
+
+def tile_regions(
+    shape: typing.Tuple[int, ...], tile_shape: typing.Tuple[int, int]
+) -> typing.List[typing.Tuple[slice, slice]]:
+    """
+    Rows and columns of the tiles covering an image, in row-major order.
+    Tiles on the bottom and right edges are cut to the image.
+
+    Args:
+        shape: tuple of int
+            Image shape.
+        tile_shape: tuple of int
+            Tile shape, ex. from aligned_tile_shape.
+
+    Return: list of tuple of slice
+    """
+    return [
+        (
+            slice(y, min(y + tile_shape[0], shape[0])),
+            slice(x, min(x + tile_shape[1], shape[1])),
+        )
+        for y in range(0, shape[0], tile_shape[0])
+        for x in range(0, shape[1], tile_shape[1])
+    ]
+
+
+def iter_tiles(page):
+    """
+    Read and decode a tiled TIFF page one tile at a time.
+
+    Args:
+        page: tifffile.TiffPage or tifffile.TiffFrame
+            Page to read, must be tiled.
+
+    Yield: tuple of (y, x, np.ndarray)
+        Tile origin and tile data of the full tile shape as stored, i.e.
+        tiles on the right and bottom edges include the padding.
+    """
+    keyframe = page.keyframe
+    tile_shape = (keyframe.tilelength, keyframe.tilewidth)
+    fh = page.parent.filehandle
+    offsets_bytecounts = zip(page.dataoffsets, page.databytecounts)
+    for index, (offset, bytecount) in enumerate(offsets_bytecounts):
+        if bytecount > 0:
+            fh.seek(offset)
+            data = fh.read(bytecount)
+        else:
+            data = None
+        segment, indices, _ = keyframe.decode(data, index)
+        y, x = indices[-3:-1]
+        if segment is None:
+            segment = np.zeros(tile_shape, keyframe.dtype)
+        yield y, x, segment.reshape(tile_shape)
+
+
+def level_pages(tif, level: int = 0) -> list:
+    """
+    Channel pages of one pyramid level of an OME-TIFF file.
+
+    Args:
+        tif: tifffile.TiffFile
+            Opened file, either with one image per level (ashlar layout) or
+            with reduced levels stored as SubIFDs.
+        level: int [optional]
+            Pyramid level, 0 being full resolution. Default 0.
+
+    Return: list of tifffile.TiffPage
+    """
+    levels = getattr(tif.series[0], "levels", [tif.series[0]])
+    if len(levels) > 1:
+        return list(levels[level].pages)
+    return list(tif.series[level].pages)
+
+
+def segment_memmap(page) -> np.ndarray:
+    """
+    Memory-map an uncompressed page whose strips are stored back to back.
+
+    Args:
+        page: tifffile.TiffPage or tifffile.TiffFrame
+            Page to map.
+
+    Return: np.memmap, or None if the page cannot be mapped.
+    """
+    keyframe = page.keyframe
+    if keyframe.is_tiled or keyframe.compression != 1:
+        return None
+    offsets, bytecounts = page.dataoffsets, page.databytecounts
+    for offset, bytecount, next_offset in zip(offsets, bytecounts, offsets[1:]):
+        if offset + bytecount != next_offset:
+            return None
+    dtype = np.dtype(keyframe.dtype).newbyteorder(page.parent.byteorder)
+    if sum(bytecounts) < keyframe.size * dtype.itemsize:
+        return None
+    return np.memmap(
+        page.parent.filehandle.path,
+        dtype=dtype,
+        mode="r",
+        offset=offsets[0],
+        shape=keyframe.shape,
+    )
+
+
+def read_regions(
+    page, region_list: typing.List[typing.Tuple[slice, slice]], lock=None
+) -> typing.List[np.ndarray]:
+    """
+    Read rectangles of a TIFF page, decoding only the tiles or strips that
+    overlap them, each of those once however many rectangles it touches.
+
+    Args:
+        page: tifffile.TiffPage or tifffile.TiffFrame
+            Page to read.
+        region_list: list of tuple of slice
+            Rows and columns of each rectangle, with step 1.
+        lock: threading.Lock [optional]
+            Guards the shared file handle when reading from several threads.
+            Decoding happens outside of it. Default None.
+
+    Return: list of np.ndarray
+    """
+    keyframe = page.keyframe
+    height, width = keyframe.shape[:2]
+    if keyframe.is_tiled:
+        seg_h, seg_w = keyframe.tilelength, keyframe.tilewidth
+    else:
+        seg_h, seg_w = min(keyframe.rowsperstrip or height, height), width
+    segs_across = -(-width // seg_w)
+    fh = page.parent.filehandle
+
+    # bounds of each rectangle and the segments it needs
+    bounds_list, out_list = [], []
+    segment_dict = collections.defaultdict(list)
+    for region in region_list:
+        (r0, r1, _), (c0, c1, _) = [
+            s.indices(n) for s, n in zip(region, (height, width))
+        ]
+        r1, c1 = max(r0, r1), max(c0, c1)
+        for ty in range(r0 // seg_h, -(-r1 // seg_h)):
+            for tx in range(c0 // seg_w, -(-c1 // seg_w)):
+                segment_dict[ty * segs_across + tx].append(len(out_list))
+        bounds_list.append((r0, r1, c0, c1))
+        out_list.append(np.zeros((r1 - r0, c1 - c0), dtype=keyframe.dtype))
+
+    for index in sorted(segment_dict):
+        bytecount = page.databytecounts[index]
+        if bytecount == 0:
+            continue
+        if lock is not None:
+            lock.acquire()
+        try:
+            fh.seek(page.dataoffsets[index])
+            data = fh.read(bytecount)
+        finally:
+            if lock is not None:
+                lock.release()
+        segment, _, _ = keyframe.decode(data, index)
+        segment = segment.reshape(segment.shape[-3:-1])
+        y, x = (index // segs_across) * seg_h, (index % segs_across) * seg_w
+        for k in segment_dict[index]:
+            r0, r1, c0, c1 = bounds_list[k]
+            ys, xs = max(r0, y), max(c0, x)
+            ye = min(r1, y + segment.shape[0])
+            xe = min(c1, x + segment.shape[1])
+            out_list[k][ys - r0 : ye - r0, xs - c0 : xe - c0] = segment[
+                ys - y : ye - y, xs - x : xe - x
+            ]
+    return out_list
+
+
+def read_region(page, region: typing.Tuple[slice, slice], lock=None) -> np.ndarray:
+    """
+    Read a rectangle of a TIFF page, decoding only the tiles or strips that
+    overlap it.
+
+    Args:
+        page: tifffile.TiffPage or tifffile.TiffFrame
+            Page to read.
+        region: tuple of slice
+            Rows and columns to read, with step 1.
+        lock: threading.Lock [optional]
+            Guards the shared file handle when reading from several threads.
+            Default None.
+
+    Return: np.ndarray
+    """
+    return read_regions(page, [region], lock=lock)[0]
+
+
+class TiffArray:
+    """
+    Lazy 2-D array backed by one channel of a TIFF file. Slicing decodes
+    only the tiles overlapping the requested region, so it can stand in for
+    np.ndarray or h5py.Dataset as input.
+
+    Args:
+        path: str
+            TIFF or OME-TIFF file path.
+        channel: int [optional]
+            Page index within the pyramid level. Default 0.
+        level: int [optional]
+            Pyramid level, 0 being full resolution. Default 0.
+    """
+
+    def __init__(self, path: str, channel: int = 0, level: int = 0):
+        self.path = str(path)
+        self.channel = channel
+        self.level = level
+        self._state = None
+        page = self._page()
+        keyframe = page.keyframe
+        self.shape = tuple(keyframe.shape)
+        self.dtype = np.dtype(keyframe.dtype)
+        self.ndim = len(self.shape)
+        if keyframe.is_tiled:
+            self.chunks = (keyframe.tilelength, keyframe.tilewidth)
+        else:
+            rows = min(keyframe.rowsperstrip or self.shape[0], self.shape[0])
+            self.chunks = (rows, self.shape[1])
+
+    def _page(self):
+        # file handles are per process, reopened after fork
+        import tifffile
+
+        if self._state is None or self._state[0] != os.getpid():
+            tif = tifffile.TiffFile(self.path)
+            page = level_pages(tif, self.level)[self.channel]
+            self._state = (os.getpid(), tif, page, segment_memmap(page), Lock())
+        return self._state[2]
+
+    def __getstate__(self):
+        return {"path": self.path, "channel": self.channel, "level": self.level}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __getitem__(self, key) -> np.ndarray:
+        page = self._page()
+        _, _, _, memmap, lock = self._state
+        if memmap is not None:
+            return np.array(memmap[key])
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (2 - len(key))
+        region, squeeze = [], []
+        for axis, k in enumerate(key):
+            if isinstance(k, slice):
+                if k.step not in (None, 1):
+                    raise IndexError("TiffArray only supports slices with step 1")
+                region.append(k)
+            else:
+                k = range(self.shape[axis])[k]
+                region.append(slice(k, k + 1))
+                squeeze.append(axis)
+        out = read_region(page, tuple(region), lock=lock)
+        return out.squeeze(axis=tuple(squeeze)) if squeeze else out
+
+    def read_regions(
+        self, region_list: typing.List[typing.Tuple[slice, slice]]
+    ) -> typing.List[np.ndarray]:
+        """
+        Read several rectangles, decoding each tile once, see read_regions.
+        """
+        page = self._page()
+        _, _, _, memmap, lock = self._state
+        if memmap is not None:
+            return [np.array(memmap[region]) for region in region_list]
+        return read_regions(page, region_list, lock=lock)
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[:, :]
+        return out if dtype is None else out.astype(dtype)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def close(self):
+        if self._state is not None:
+            self._state[1].close()
+            self._state = None
+
+
+def read_crops(
+    image: typing.Any, region_list: typing.List[typing.Tuple[slice, slice]]
+) -> typing.List[np.ndarray]:
+    """
+    Read several rectangles of an image at once. Tiles of a util.TiffArray
+    are decoded once however many rectangles they touch; other arrays are
+    read once over the bounding box when the rectangles cover most of it,
+    else one rectangle at a time.
+
+    Args:
+        image: array-like
+            Image sliceable like np.ndarray.
+        region_list: list of tuple of slice
+            Rows and columns of each rectangle, with step 1.
+
+    Return: list of np.ndarray
+    """
+    if isinstance(image, TiffArray):
+        return image.read_regions(region_list)
+    if isinstance(image, np.ndarray) or not region_list:
+        return [np.asarray(image[region]) for region in region_list]
+    bounds = np.array(
+        [
+            [s.indices(n)[:2] for s, n in zip(region, image.shape[:2])]
+            for region in region_list
+        ]
+    ).reshape(-1, 4)
+    bounds[:, 1] = np.maximum(bounds[:, 0], bounds[:, 1])
+    bounds[:, 3] = np.maximum(bounds[:, 2], bounds[:, 3])
+    r0, c0 = bounds[:, 0].min(), bounds[:, 2].min()
+    r1, c1 = bounds[:, 1].max(), bounds[:, 3].max()
+    area = (bounds[:, 1] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 2])
+    if (r1 - r0) * (c1 - c0) > 4 * area.sum():
+        return [np.asarray(image[region]) for region in region_list]
+    block = np.asarray(image[r0:r1, c0:c1])
+    return [block[a - r0 : b - r0, c - c0 : d - c0] for a, b, c, d in bounds]
+
+
+class ChannelArray:
+    """
+    Lazy 2-D view of one channel of a multi-channel array such as zarr.Array
+    or h5py.Dataset. Slicing reads only the requested region, so it can
+    stand in for np.ndarray as input.
+
+    Args:
+        array: array-like
+            Array of shape (..., y, x), read by slicing.
+        index: tuple of int
+            Index of the channel along the leading axes, ex. (c,) for an
+            array of shape (c, y, x).
+    """
+
+    def __init__(self, array: typing.Any, index: typing.Tuple[int, ...]):
+        self.array = array
+        self.index = tuple(index)
+        self.shape = tuple(array.shape[len(self.index) :])
+        self.dtype = np.dtype(array.dtype)
+        self.ndim = len(self.shape)
+        self.chunks = chunk_shape(array)
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        return np.asarray(self.array[self.index + key])
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[:, :]
+        return out if dtype is None else out.astype(dtype)
+
+    def __len__(self) -> int:
+        return self.shape[0]
@@ -14,6 +14,9 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/hungyiwu/pca_analysis_toolkit",
     packages=setuptools.find_packages(),
+    entry_points={
+        "console_scripts": ["pcatk=pcatk.cli:main"],
+        },
     install_requires=[
         "numpy",
         "scikit-image",